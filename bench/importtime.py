@@ -0,0 +1,86 @@
+"""
+Check that `tiktoker --help` starts quickly, using `python -X importtime`.
+
+Fails if any of the heavy dependencies get imported at startup again, or if
+the total import time goes over `--budget-ms`.
+"""
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Annotated
+
+import typer
+
+app = typer.Typer()
+
+# only needed once a command actually runs
+_HEAVY_MODULES = ("httpx", "pydantic", "tenacity", "structlog", "sqlite3")
+
+
+@dataclass(frozen=True, slots=True)
+class _Import:
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def _parse(stderr: str) -> list[_Import]:
+    # lines look like: `import time:       123 |        456 |   module.name`
+    imports: list[_Import] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module = line.removeprefix("import time:").split("|")
+        if not self_us.strip().isdigit():
+            # the header row
+            continue
+        imports.append(
+            _Import(
+                module=module.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+            )
+        )
+    return imports
+
+
+@app.command()
+def main(
+    budget_ms: Annotated[
+        float, typer.Option(help="fail if importing takes longer than this")
+    ] = 500,
+    top: Annotated[int, typer.Option(help="slowest imports to show")] = 10,
+) -> None:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "tiktoker", "--help"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = _parse(proc.stderr)
+    total_us = sum(i.self_us for i in imports)
+
+    for i in sorted(imports, key=lambda i: i.self_us, reverse=True)[:top]:
+        print(f"{i.self_us / 1000:8.2f}ms  {i.module}")  # noqa: T201
+    print(f"{total_us / 1000:8.2f}ms  total ({len(imports)} modules)")  # noqa: T201
+
+    heavy = sorted(
+        {
+            i.module
+            for i in imports
+            if i.module.split(".")[0].lstrip("_") in _HEAVY_MODULES
+        }
+    )
+    failed = False
+    if heavy:
+        print(f"imported at startup: {', '.join(heavy)}")  # noqa: T201
+        failed = True
+    if total_us / 1000 > budget_ms:
+        print(f"over budget of {budget_ms}ms")  # noqa: T201
+        failed = True
+    if failed:
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    app()
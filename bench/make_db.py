@@ -0,0 +1,73 @@
+"""
+Build a database that looks like a finished export of `--posts` favorites,
+without going through the api.
+"""
+import json
+import time
+from typing import Annotated
+
+import typer
+from structlog.stdlib import get_logger
+
+from bench.stub_server import START, fake_post
+from tiktoker.db import DB, PostCreateParams, RequestCreateParams
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    path_sqlite: Annotated[str, typer.Option("--sqlite-path")],
+    posts: Annotated[int, typer.Option()] = 100_000,
+    page_size: Annotated[int, typer.Option()] = 30,
+    slideshow_every: Annotated[int, typer.Option(min=1)] = 5,
+    base_url: Annotated[
+        str, typer.Option(help="where the media urls in the posts point to")
+    ] = "http://127.0.0.1:8765",
+) -> None:
+    log = get_logger()
+    db = DB.create(path=path_sqlite, log=log, write_mode=True)
+    exp = db.export.get_or_create(account="bench")
+    start = time.monotonic()
+    with db.batched_commits(every=100) as page_done:
+        for first in range(0, posts, page_size):
+            page = [
+                fake_post(idx, base_url=base_url, slideshow_every=slideshow_every)
+                for idx in range(first, min(first + page_size, posts))
+            ]
+            cursor = START + 1 if first == 0 else page[0]["createTime"] + 1
+            request_id = db.requests.create(
+                RequestCreateParams(
+                    export_id=exp.export_id,
+                    http_request_duration_sec=0.0,
+                    http_request_connect_sec=None,
+                    http_request_tls_sec=None,
+                    http_request_param_cursor=cursor,
+                    http_request_url=f"{base_url}/api/user/collect/item_list/?cursor={cursor}",
+                    http_response_headers_json={"content-type": "application/json"},
+                )
+            )
+            db.posts.create(
+                [
+                    PostCreateParams(
+                        export_id=exp.export_id,
+                        request_id=request_id,
+                        post_json=json.dumps(post, separators=(",", ":")),
+                    )
+                    for post in page
+                ]
+            )
+            db.export.checkpoint(export_id=exp.export_id, cursor=cursor)
+            page_done()
+    db.export.complete(export_id=exp.export_id)
+    log.info(
+        "created db",
+        export_id=exp.export_id,
+        posts=posts,
+        duration_sec=time.monotonic() - start,
+        size_bytes=db.size_bytes(),
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,260 @@
+"""
+Run the tiktoker commands against `bench.stub_server` and report how fast
+they went as JSON, so runs from different commits can be compared.
+
+Each command runs in its own process so peak RSS is per command.
+"""
+import json
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Generator, Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated, Any, Optional
+
+import typer
+
+app = typer.Typer()
+
+_REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+@dataclass(frozen=True, slots=True)
+class _Run:
+    duration_sec: float
+    peak_rss_bytes: int
+
+
+def _env(**extra: str) -> dict[str, str]:
+    return {**os.environ, "PYTHONPATH": str(_REPO_ROOT), **extra}
+
+
+def _run(args: Sequence[str], **env: str) -> _Run:
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, *args],
+        cwd=_REPO_ROOT,
+        env=_env(**env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    duration_sec = time.monotonic() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{args} exited with {proc.returncode}")
+    # linux reports kilobytes, macos bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return _Run(duration_sec=duration_sec, peak_rss_bytes=rusage.ru_maxrss * scale)
+
+
+@contextmanager
+def _stub_server(port: int, *args: str) -> Generator[str, None, None]:
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "bench.stub_server", "--port", str(port), *args],
+        cwd=_REPO_ROOT,
+        env=_env(),
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _count(path: Path, sql: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        (count,) = conn.execute(sql).fetchone()
+        return count
+    finally:
+        conn.close()
+
+
+def _db_size_bytes(path: Path) -> int:
+    return sum(
+        p.stat().st_size
+        for p in (path, path.with_name(path.name + "-wal"))
+        if p.exists()
+    )
+
+
+def _rate(count: int, run: _Run) -> float:
+    return round(count / run.duration_sec, 2)
+
+
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=_REPO_ROOT,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def main(
+    posts: Annotated[int, typer.Option(help="favorites served by the stub api")] = 3000,
+    new_posts: Annotated[
+        int, typer.Option(help="favorites added before the sync run")
+    ] = 25,
+    db_posts: Annotated[int, typer.Option(help="posts in the generated db")] = 100_000,
+    latency_ms: Annotated[float, typer.Option()] = 20,
+    error_rate: Annotated[float, typer.Option()] = 0,
+    throttle_rate: Annotated[float, typer.Option()] = 0,
+    port: Annotated[int, typer.Option()] = 8765,
+    work_dir: Annotated[
+        Optional[Path],  # noqa: UP007
+        typer.Option(help="where to put the dbs and images, defaults to a temp dir"),
+    ] = None,
+    output: Annotated[
+        Optional[Path],  # noqa: UP007
+        typer.Option(help="write the results here instead of stdout"),
+    ] = None,
+) -> None:
+    work_dir = work_dir or Path(tempfile.mkdtemp(prefix="tiktoker-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    db_path = work_dir / "export.db"
+    db_path.unlink(missing_ok=True)
+    server_args = [
+        "--posts",
+        str(posts),
+        "--latency-ms",
+        str(latency_ms),
+        "--error-rate",
+        str(error_rate),
+        "--throttle-rate",
+        str(throttle_rate),
+    ]
+    count_requests = "select count(*) from tiktok_requests"
+    count_posts = "select count(*) from tiktok_posts"
+    results: dict[str, dict[str, Any]] = {}
+
+    with _stub_server(port, *server_args) as base_url:
+        run = _run(
+            [
+                "-m",
+                "tiktoker",
+                "export-favorites-metadata",
+                "--session-id=bench",
+                f"--sqlite-path={db_path}",
+                f"--video-urls-path={work_dir / 'urls.txt'}",
+            ],
+            TIKTOKER_API_BASE_URL=base_url,
+        )
+        pages = _count(db_path, count_requests)
+        inserted = _count(db_path, count_posts)
+        results["export_favorites_metadata"] = {
+            "duration_sec": round(run.duration_sec, 3),
+            "pages": pages,
+            "pages_per_sec": _rate(pages, run),
+            "inserts": inserted,
+            "inserts_per_sec": _rate(inserted, run),
+            "peak_rss_bytes": run.peak_rss_bytes,
+            "db_size_bytes": _db_size_bytes(db_path),
+        }
+
+    with _stub_server(port, *server_args, "--new-posts", str(new_posts)) as base_url:
+        run = _run(
+            [
+                "-m",
+                "tiktoker",
+                "export-favorites-metadata",
+                "--session-id=bench",
+                f"--sqlite-path={db_path}",
+                f"--video-urls-path={work_dir / 'urls-new.txt'}",
+                "--since-export-id=1",
+            ],
+            TIKTOKER_API_BASE_URL=base_url,
+        )
+        sync_pages = _count(db_path, count_requests) - pages
+        sync_inserted = _count(db_path, count_posts) - inserted
+        results["export_favorites_metadata_sync"] = {
+            "duration_sec": round(run.duration_sec, 3),
+            "pages": sync_pages,
+            "inserts": sync_inserted,
+            "peak_rss_bytes": run.peak_rss_bytes,
+        }
+
+    with _stub_server(port, *server_args):
+        run = _run(
+            [
+                "-m",
+                "tiktoker",
+                "export-slideshow-images",
+                "--export-id=1",
+                f"--sqlite-path={db_path}",
+                f"--image-dir-path={work_dir / 'images'}",
+            ]
+        )
+        images = _count(
+            db_path, "select count(*) from tiktok_media where status = 'complete'"
+        )
+        results["export_slideshow_images"] = {
+            "duration_sec": round(run.duration_sec, 3),
+            "images": images,
+            "images_per_sec": _rate(images, run),
+            "peak_rss_bytes": run.peak_rss_bytes,
+        }
+
+    generated_db_path = work_dir / "generated.db"
+    generated_db_path.unlink(missing_ok=True)
+    run = _run(
+        [
+            "-m",
+            "bench.make_db",
+            f"--sqlite-path={generated_db_path}",
+            f"--posts={db_posts}",
+        ]
+    )
+    results["make_db"] = {
+        "duration_sec": round(run.duration_sec, 3),
+        "inserts": db_posts,
+        "inserts_per_sec": _rate(db_posts, run),
+        "peak_rss_bytes": run.peak_rss_bytes,
+        "db_size_bytes": _db_size_bytes(generated_db_path),
+    }
+
+    report = {
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "posts": posts,
+            "new_posts": new_posts,
+            "db_posts": db_posts,
+            "latency_ms": latency_ms,
+            "error_rate": error_rate,
+            "throttle_rate": throttle_rate,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output is not None:
+        output.write_text(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    app()
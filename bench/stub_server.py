@@ -0,0 +1,256 @@
+"""
+Stand-in for TikTok's favorites api and media cdn.
+
+Serves `item_list` pages in the same shape as the real api, and the images,
+videos and audio linked from them, with optional latency, errors and
+throttling. Videos and audio honor `Range` requests like the real cdn.
+Everything is derived from the request so responses are stable between runs.
+"""
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Annotated, Any
+from urllib.parse import parse_qs, urlparse
+
+import typer
+
+# newest `createTime` served, new posts (see `--new-posts`) are newer than this
+START = 1_700_000_000
+
+# seconds between posts, so the collection spans a few years like a real one
+_POST_SPACING_SEC = 3600
+
+# image urls are signed like the real ones and need to outlive the benchmark
+_EXPIRES = START + 10 * 365 * 24 * 3600
+
+app = typer.Typer()
+
+
+def fake_post(idx: int, *, base_url: str, slideshow_every: int) -> dict[str, Any]:
+    """
+    Post number `idx` counting back from the newest, negative `idx` are the
+    posts added since the initial export.
+    """
+    create_time = START - idx * _POST_SPACING_SEC
+    post_id = str(7_000_000_000_000_000_000 + create_time)
+    author = f"user{idx % 997}"
+    post: dict[str, Any] = {
+        "id": post_id,
+        "desc": f"post {post_id} #bench #fyp " + "lorem ipsum " * (idx % 7),
+        "createTime": create_time,
+        "author": {
+            "id": str(idx % 997),
+            "uniqueId": author,
+            "nickname": author.title(),
+            "avatarThumb": f"{base_url}/avatar/{idx % 997}.jpeg",
+        },
+        "stats": {
+            "diggCount": idx * 7 % 100_000,
+            "shareCount": idx * 3 % 1000,
+            "commentCount": idx * 5 % 1000,
+            "playCount": idx * 11 % 1_000_000,
+        },
+        "challenges": [{"id": "1", "title": "bench"}, {"id": "2", "title": "fyp"}],
+        "video": {
+            "id": post_id,
+            "duration": 15 + idx % 45,
+            "playAddr": f"{base_url}/video/{post_id}.mp4?expire={_EXPIRES}",
+            "downloadAddr": f"{base_url}/video/{post_id}.mp4?expire={_EXPIRES}&dl=1",
+        },
+        "music": {
+            "id": str(idx % 101),
+            "title": f"original sound - {author}",
+            "playUrl": f"{base_url}/music/{idx % 101}.mp3?expire={_EXPIRES}",
+        },
+    }
+    if idx % slideshow_every == 0:
+        post["imagePost"] = {
+            "images": [
+                {
+                    "imageURL": {
+                        "urlList": [
+                            f"{base_url}/img/{post_id}/{slide}.jpeg?x-expires={_EXPIRES}"
+                        ]
+                    }
+                }
+                for slide in range(1 + idx % 4)
+            ]
+        }
+    return post
+
+
+def _media(path: str, *, size: int) -> bytes:
+    # incompressible but stable, so the blob store sees distinct files
+    seed = hashlib.sha256(path.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def _byte_range(header: str | None, *, size: int) -> tuple[int, int] | None:
+    """
+    The first range of a `Range: bytes=start-end` header, end inclusive.
+    """
+    if header is None or not header.startswith("bytes="):
+        return None
+    start, _, end = header.removeprefix("bytes=").split(",")[0].partition("-")
+    if not start:
+        # a suffix range, the last `end` bytes
+        return max(size - int(end), 0), size - 1
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+class StubServer(ThreadingHTTPServer):
+    def __init__(
+        self, address: tuple[str, int], handler: type[BaseHTTPRequestHandler]
+    ) -> None:
+        super().__init__(address, handler)
+        # cursors of the `item_list` requests served, in order
+        self.api_cursors = list[int]()
+
+
+def make_server(
+    *,
+    port: int = 0,
+    posts: int = 3000,
+    new_posts: int = 0,
+    page_size: int = 30,
+    slideshow_every: int = 5,
+    image_size: int = 64 * 1024,
+    video_size: int = 512 * 1024,
+    latency_ms: float = 0,
+    error_rate: float = 0,
+    throttle_rate: float = 0,
+) -> StubServer:
+    """
+    The stub, not started yet. Port 0 picks a free one, see `server_port`.
+    """
+    # the port isn't known until the server is bound, see below
+    base_url = ""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(
+            self,
+            status: int,
+            body: bytes,
+            content_type: str,
+            headers: dict[str, str] | None = None,
+        ) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_ranged(self, body: bytes, content_type: str) -> None:
+            headers = {"Accept-Ranges": "bytes"}
+            byte_range = _byte_range(self.headers.get("Range"), size=len(body))
+            if byte_range is None:
+                self._send(200, body, content_type, headers)
+                return
+            start, end = byte_range
+            if start >= len(body):
+                headers["Content-Range"] = f"bytes */{len(body)}"
+                self._send(416, b"", "text/plain", headers)
+                return
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            self._send(206, body[start : end + 1], content_type, headers)
+
+        def do_GET(self) -> None:  # noqa: N802
+            if latency_ms:
+                time.sleep(random.expovariate(1000 / latency_ms))
+            roll = random.random()
+            if roll < throttle_rate:
+                self._send(429, b"", "text/plain")
+                return
+            if roll < throttle_rate + error_rate:
+                self._send(500, b"", "text/plain")
+                return
+
+            url = urlparse(self.path)
+            if url.path == "/api/user/collect/item_list/":
+                self._send(200, self._page(url.query), "application/json")
+            elif url.path.startswith("/img/"):
+                self._send(200, _media(url.path, size=image_size), "image/jpeg")
+            elif url.path.startswith("/video/"):
+                self._send_ranged(_media(url.path, size=video_size), "video/mp4")
+            elif url.path.startswith("/music/"):
+                self._send_ranged(_media(url.path, size=video_size), "audio/mpeg")
+            else:
+                self._send(404, b"", "text/plain")
+
+        def _page(self, query: str) -> bytes:
+            cursor = int(parse_qs(query)["cursor"][0])
+            assert isinstance(self.server, StubServer)
+            self.server.api_cursors.append(cursor)
+            # `cursor` is a `createTime`, the page has the posts older than it
+            first = max(-new_posts, -((cursor - START - 1) // _POST_SPACING_SEC))
+            last = min(first + page_size, posts)
+            items = [
+                fake_post(idx, base_url=base_url, slideshow_every=slideshow_every)
+                for idx in range(first, last)
+            ]
+            return json.dumps(
+                {
+                    "hasMore": last < posts,
+                    "cursor": items[-1]["createTime"] if items else cursor,
+                    "itemList": items,
+                    "statusCode": 0,
+                }
+            ).encode()
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = StubServer(("127.0.0.1", port), Handler)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    return server
+
+
+@app.command()
+def main(
+    port: Annotated[int, typer.Option()] = 8765,
+    posts: Annotated[int, typer.Option(help="number of favorites")] = 3000,
+    new_posts: Annotated[
+        int, typer.Option(help="posts added since the initial export")
+    ] = 0,
+    page_size: Annotated[int, typer.Option()] = 30,
+    slideshow_every: Annotated[
+        int, typer.Option(min=1, help="every nth post is a slideshow")
+    ] = 5,
+    image_size: Annotated[int, typer.Option(help="bytes per image")] = 64 * 1024,
+    video_size: Annotated[
+        int, typer.Option(help="bytes per video or audio track")
+    ] = 512 * 1024,
+    latency_ms: Annotated[
+        float, typer.Option(help="mean added latency per response")
+    ] = 0,
+    error_rate: Annotated[
+        float, typer.Option(help="fraction of responses that are a 500")
+    ] = 0,
+    throttle_rate: Annotated[
+        float, typer.Option(help="fraction of responses that are a 429")
+    ] = 0,
+) -> None:
+    make_server(
+        port=port,
+        posts=posts,
+        new_posts=new_posts,
+        page_size=page_size,
+        slideshow_every=slideshow_every,
+        image_size=image_size,
+        video_size=video_size,
+        latency_ms=latency_ms,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+    ).serve_forever()
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,40 @@
+import threading
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any
+
+import pytest
+from structlog.stdlib import get_logger
+
+from bench.stub_server import StubServer, make_server
+from tiktoker.db import DB
+
+
+@pytest.fixture
+def db_path(tmp_path: Path) -> str:
+    return str(tmp_path / "tiktok.db")
+
+
+@pytest.fixture
+def db(db_path: str) -> DB:
+    return DB.create(path=db_path, log=get_logger(), write_mode=True)
+
+
+@pytest.fixture
+def stub() -> Iterator[Callable[..., StubServer]]:
+    """
+    Starts `bench.stub_server` in the background, takes `make_server`'s
+    arguments.
+    """
+    servers = list[StubServer]()
+
+    def start(**kwargs: Any) -> StubServer:
+        server = make_server(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,30 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+from tiktoker.blobs import BlobStore
+
+
+def test_writer_syncs_blob_and_directory(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    store = BlobStore.create(tmp_path / "blobs")
+    synced = list[str]()
+    real_fsync = os.fsync
+
+    def fsync(fd: int) -> None:
+        synced.append(os.readlink(f"/proc/self/fd/{fd}"))
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    with store.writer() as writer:
+        writer.write(b"image")
+
+    sha256 = hashlib.sha256(b"image").hexdigest()
+    assert store.path(sha256).read_bytes() == b"image"
+    # the temp file before it's renamed, then the directory it's renamed into
+    assert len(synced) == 2
+    assert Path(synced[0]).parent == tmp_path / "blobs" / "tmp"
+    assert Path(synced[1]) == store.path(sha256).parent
@@ -0,0 +1,19 @@
+from structlog.stdlib import get_logger
+
+from tests.utils import posts, save_posts
+from tiktoker.commands.compact import compact
+from tiktoker.db import DB
+
+
+def test_reads_posts_compacted_by_another_connection(db: DB, db_path: str) -> None:
+    exp = db.export.get_or_create(account="account")
+    save_posts(db, export_id=exp.export_id, posts=posts(50))
+    before = list(db.posts.slideshows(export_id=exp.export_id))
+    assert before
+
+    # e.g. `tiktoker compact` running while the daemon is up
+    compact(path_sqlite=db_path, codec="zlib", sample_size=50, dict_size=4096)
+
+    assert list(db.posts.slideshows(export_id=exp.export_id)) == before
+    other = DB.create(path=db_path, log=get_logger())
+    assert list(other.posts.slideshows(export_id=exp.export_id)) == before
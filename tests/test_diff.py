@@ -0,0 +1,37 @@
+import copy
+
+from tests.utils import posts, save_posts
+from tiktoker.db import DB
+
+
+def test_diff_ignores_stats_and_media_urls(db: DB) -> None:
+    first = db.export.get_or_create(account="alice")
+    before = posts(10)
+    save_posts(db, export_id=first.export_id, posts=before[1:])
+    db.export.complete(export_id=first.export_id)
+
+    after = copy.deepcopy(before[:-1])
+    for post in after:
+        # refetched a day later
+        post["stats"]["playCount"] += 1000
+        post["video"]["playAddr"] += "&signature=new"
+        post["music"]["playUrl"] += "&signature=new"
+        for image in post.get("imagePost", {}).get("images", []):
+            image["imageURL"]["urlList"] = [
+                url + "&signature=new" for url in image["imageURL"]["urlList"]
+            ]
+    after[3]["desc"] = "edited"
+    second = db.export.get_or_create(account="alice")
+    save_posts(db, export_id=second.export_id, posts=after)
+
+    changes = {
+        (change.change, change.id)
+        for change in db.posts.diff(
+            export_id=second.export_id, prior_export_ids=[first.export_id]
+        )
+    }
+    assert changes == {
+        ("added", before[0]["id"]),
+        ("removed", before[-1]["id"]),
+        ("changed", before[3]["id"]),
+    }
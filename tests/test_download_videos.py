@@ -0,0 +1,32 @@
+import pytest
+
+from tiktoker.commands.download_videos import _filename_stem
+from tiktoker.db import PostVideo
+
+
+def _post(desc: str, *, author: str = "alice") -> PostVideo:
+    return PostVideo(id="7001", author=author, desc=desc, is_video=True, url="")
+
+
+# expected names are what yt-dlp 2026.08.19 produces for the README's template
+@pytest.mark.parametrize(
+    ("desc", "stem"),
+    [
+        ("plain", "tiktok@alice:7001:plain"),
+        ("ratio 16:9 vs a:b", "tiktok@alice:7001:ratio 16_9 vs a\uff1ab"),
+        ("why? no.", "tiktok@alice:7001:why\uff1f no."),
+        ("first\nsecond\n", "tiktok@alice:7001:first second"),
+        ("a/b\\c", "tiktok@alice:7001:a\u29f8b\u29f9c"),
+        ('"*<>|', "tiktok@alice:7001:\uff02\uff0a\uff1c\uff1e\uff5c"),
+        ("", "tiktok@alice:7001:TikTok video #7001"),
+        ("x" * 80, "tiktok@alice:7001:" + "x" * 69 + "..."),
+        # 100 bytes cuts the 34th character in half
+        ("日" * 40, "tiktok@alice:7001:" + "日" * 33),
+    ],
+)
+def test_filename_stem_matches_yt_dlp(desc: str, stem: str) -> None:
+    assert _filename_stem(_post(desc)) == stem
+
+
+def test_filename_stem_sanitizes_author() -> None:
+    assert _filename_stem(_post("hi", author="a?b")) == "tiktok@a\uff1fb:7001:hi"
@@ -0,0 +1,35 @@
+from tiktoker.db import DB
+
+
+def test_resumes_the_export_in_progress_without_an_account(db: DB) -> None:
+    # e.g. started with an earlier session id, before logging in again
+    exp = db.export.get_or_create(account="alice")
+
+    assert db.export.get_or_create(account=None) == exp
+
+
+def test_resumes_the_accounts_own_export(db: DB) -> None:
+    alice = db.export.get_or_create(account="alice")
+    bob = db.export.get_or_create(account="bob")
+
+    assert alice != bob
+    assert db.export.get_or_create(account="alice") == alice
+    assert db.export.get_or_create(account="bob") == bob
+    assert db.export.in_progress() == [alice, bob]
+
+
+def test_claims_an_export_from_before_accounts(db: DB) -> None:
+    exp = db.export.get_or_create(account=None)
+
+    assert db.export.get_or_create(account="alice") == exp
+    assert db.export.get_or_create(account="bob") != exp
+
+
+def test_prior_ids_of_the_same_account(db: DB) -> None:
+    first = db.export.get_or_create(account="alice")
+    db.export.complete(export_id=first.export_id)
+    other = db.export.get_or_create(account="bob")
+    db.export.complete(export_id=other.export_id)
+    second = db.export.get_or_create(account="alice")
+
+    assert db.export.prior_ids(export_id=second.export_id) == [first.export_id]
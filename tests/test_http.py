@@ -0,0 +1,71 @@
+import asyncio
+from pathlib import Path
+
+import httpx
+import pytest
+from tenacity import wait_none
+
+from tiktoker.blobs import BlobStore
+from tiktoker.http import download_blob
+from tiktoker.ratelimit import RateLimiters
+
+URL = "http://cdn.test/img/1.jpeg"
+
+
+def _download(tmp_path: Path, statuses: list[int]) -> tuple[object, int]:
+    """
+    Download `URL` from a server answering with `statuses` in turn, returns
+    the result (or the error raised) and how many requests were made.
+    """
+    requests = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal requests
+        status = statuses[min(requests, len(statuses) - 1)]
+        requests += 1
+        return httpx.Response(status, content=b"image")
+
+    limiters = RateLimiters()
+    # pacing isn't under test, don't wait between the mocked requests
+    limiter = limiters.for_url(URL)
+    limiter.rate = limiter.min_rate = limiter.max_rate = 10_000
+
+    async def run() -> object:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            try:
+                return await download_blob.retry_with(wait=wait_none())(
+                    client,
+                    url=URL,
+                    store=BlobStore.create(tmp_path),
+                    limiters=limiters,
+                )
+            except httpx.HTTPError as e:
+                return e
+
+    return asyncio.run(run()), requests
+
+
+@pytest.mark.parametrize("status", [403, 404, 410])
+def test_download_blob_does_not_retry_client_errors(
+    tmp_path: Path, status: int
+) -> None:
+    res, requests = _download(tmp_path, [status])
+    assert isinstance(res, httpx.HTTPStatusError)
+    assert res.response.status_code == status
+    assert requests == 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_download_blob_gives_up_on_retryable_errors(
+    tmp_path: Path, status: int
+) -> None:
+    res, requests = _download(tmp_path, [status])
+    # the last error, not tenacity's RetryError, so callers can record it
+    assert isinstance(res, httpx.HTTPStatusError)
+    assert requests == 5
+
+
+def test_download_blob_retries_until_success(tmp_path: Path) -> None:
+    res, requests = _download(tmp_path, [503, 429, 200])
+    assert not isinstance(res, httpx.HTTPError)
+    assert requests == 3
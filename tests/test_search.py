@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import pytest
+from typer.testing import CliRunner
+
+from tiktoker.__main__ import app
+
+
+@pytest.mark.parametrize("after", ["12", "abc:1", "-1.5:x", ""])
+def test_bad_after_is_a_usage_error(tmp_path: Path, after: str) -> None:
+    result = CliRunner().invoke(
+        app,
+        ["search", "cats", f"--sqlite-path={tmp_path / 'db'}", f"--after={after}"],
+    )
+    assert result.exit_code == 2
+    assert "expected rank:rowid" in result.output
+    assert not (tmp_path / "db").exists()
+
+
+def test_after_from_results_is_accepted(tmp_path: Path) -> None:
+    result = CliRunner().invoke(
+        app,
+        ["search", "cats", f"--sqlite-path={tmp_path / 'db'}", "--after=-1.5e-06:42"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "0 results" in result.output
@@ -0,0 +1,62 @@
+from collections.abc import Callable
+
+from structlog.stdlib import get_logger
+
+from bench.stub_server import StubServer
+from tests.utils import posts, save_posts
+from tiktoker.commands.export_favorites_metadata import sync_latest
+from tiktoker.db import DB
+from tiktoker.tiktok import TikTok
+
+
+def _sync(db: DB, server: StubServer, *, export_id: int) -> int:
+    log = get_logger()
+    most_recent_cursor = db.export.get_most_recent_cursor(export_id=export_id)
+    assert most_recent_cursor is not None
+    with TikTok.create(
+        log,
+        session_id="session",
+        base_url=f"http://127.0.0.1:{server.server_port}",
+    ) as api:
+        return sync_latest(
+            db,
+            api,
+            export_id=export_id,
+            most_recent_cursor=most_recent_cursor,
+            known_post_ids=db.posts.known_ids(export_id=export_id),
+            commit_interval=1,
+            log=log,
+        )
+
+
+def test_sync_with_a_few_new_favorites_is_one_request(
+    db: DB, stub: Callable[..., StubServer]
+) -> None:
+    exp = db.export.get_or_create(account="alice")
+    # the cursor's too old to stop on, so the known posts have to
+    save_posts(db, export_id=exp.export_id, posts=posts(100), cursor=0)
+    server = stub(posts=100, new_posts=5)
+
+    assert _sync(db, server, export_id=exp.export_id) == 5
+    assert len(server.api_cursors) == 1
+
+
+def test_sync_saves_every_new_page(db: DB, stub: Callable[..., StubServer]) -> None:
+    exp = db.export.get_or_create(account="alice")
+    save_posts(db, export_id=exp.export_id, posts=posts(100), cursor=0)
+    server = stub(posts=100, new_posts=45)
+
+    assert _sync(db, server, export_id=exp.export_id) == 45
+    assert len(db.posts.known_ids(export_id=exp.export_id)) == 145
+
+
+def test_sync_records_posts_saved_by_another_account(
+    db: DB, stub: Callable[..., StubServer]
+) -> None:
+    alice = db.export.get_or_create(account="alice")
+    save_posts(db, export_id=alice.export_id, posts=posts(100), cursor=0)
+    bob = db.export.get_or_create(account="bob")
+    save_posts(db, export_id=bob.export_id, posts=posts(100)[45:], cursor=0)
+    server = stub(posts=100)
+
+    assert _sync(db, server, export_id=bob.export_id) == 45
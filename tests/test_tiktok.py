@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from tests.utils import posts
+from tiktoker.tiktok import _parse_list_page
+
+ITEM_A = '{"id": "1", "desc": "a, b"}'
+ITEM_B = '{"id": "2", "desc": "}]"}'
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_parse_list_page_keeps_item_text(indent: int | None) -> None:
+    items = posts(3)
+    content = json.dumps(
+        {"cursor": 123, "itemList": items, "hasMore": True, "extra": [1, {}]},
+        indent=indent,
+    )
+    page = _parse_list_page(f" {content}\n".encode())
+    assert page.cursor == 123
+    assert page.hasMore
+    assert [post.id for post in page.itemList] == [item["id"] for item in items]
+    assert [json.loads(post.text) for post in page.itemList] == items
+
+
+def test_parse_list_page_empty_list() -> None:
+    page = _parse_list_page(b'{"cursor":0,"hasMore":false,"itemList":[ ]}')
+    assert page.itemList == []
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        # missing separators
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A} {ITEM_B}]}}',
+        f'{{"cursor": 0 "hasMore": false, "itemList": [{ITEM_A}]}}',
+        f'{{"cursor": 0, "hasMore": false "itemList": [{ITEM_A}]}}',
+        f'{{"cursor": 0, "hasMore": false, "itemList" [{ITEM_A}]}}',
+        # trailing separators
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A},]}}',
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A}],}}',
+        f'{{"cursor": 0, "hasMore": false, "itemList": [,{ITEM_A}]}}',
+        # trailing data
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A}]}} {{}}',
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A}]}}]',
+        # bad keys, or cut short
+        '{cursor: 0, "hasMore": false, "itemList": []}',
+        f'{{"cursor": 0, "hasMore": false, "itemList": [{ITEM_A}',
+        '{"cursor": 0, "hasMore": false, "itemList": []',
+        "",
+    ],
+)
+def test_parse_list_page_rejects_malformed(content: str) -> None:
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(content)
+    with pytest.raises(json.JSONDecodeError):
+        _parse_list_page(content.encode())
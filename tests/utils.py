@@ -0,0 +1,46 @@
+import json
+from collections.abc import Sequence
+from typing import Any
+
+from bench.stub_server import fake_post
+from tiktoker.db import DB, PostCreateParams, RequestCreateParams
+
+BASE_URL = "http://127.0.0.1:8765"
+
+
+def posts(count: int, *, slideshow_every: int = 5) -> list[dict[str, Any]]:
+    return [
+        fake_post(idx, base_url=BASE_URL, slideshow_every=slideshow_every)
+        for idx in range(count)
+    ]
+
+
+def save_posts(
+    db: DB, *, export_id: int, posts: Sequence[dict[str, Any]], cursor: int = 0
+) -> None:
+    """
+    Save `posts` to the export as one page, like a fetch from the api would.
+    """
+    with db.batched_commits(every=1) as page_done:
+        request_id = db.requests.create(
+            RequestCreateParams(
+                export_id=export_id,
+                http_request_duration_sec=0.0,
+                http_request_connect_sec=None,
+                http_request_tls_sec=None,
+                http_request_param_cursor=cursor,
+                http_request_url=f"{BASE_URL}/api/user/collect/item_list/?cursor={cursor}",
+                http_response_headers_json={},
+            )
+        )
+        db.posts.create(
+            [
+                PostCreateParams(
+                    export_id=export_id,
+                    request_id=request_id,
+                    post_json=json.dumps(post),
+                )
+                for post in posts
+            ]
+        )
+        page_done()
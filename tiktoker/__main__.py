@@ -1,28 +1,74 @@
-from typing import Annotated, Optional
+from pathlib import Path
+from typing import Annotated, Optional, cast, get_args
 
 import typer
 
-from tiktoker.commands.export_favorites_metadata import (
-    export_favorites_metadata as export_favorites_metadata_,
-)
-from tiktoker.commands.export_favorites_metadata import (
-    export_favorites_metadata_sync_latest,
-)
-from tiktoker.commands.export_slideshow_images import (
-    export_slideshow_images as export_slideshow_images_,
-)
+# Command implementations are imported inside each command so `--help` and
+# the cheap commands don't pay for loading httpx, pydantic and friends.
+# `s/importtime` checks this stays true.
 
 app = typer.Typer()
 
 DEFAULT_SQLITE_PATH = "tiktok-scraper.db"
+PROFILE_PATH = "tiktoker.prof"
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    path_metrics: Annotated[
+        Optional[str],  # noqa: UP007
+        typer.Option(
+            "--metrics-path",
+            help="write per-phase timings here when the command finishes, as a prometheus textfile if it ends in .prom, otherwise json",
+        ),
+    ] = None,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            help=f"run the command under cProfile and tracemalloc and save the profile to {PROFILE_PATH}",
+        ),
+    ] = False,
+) -> None:
+    def report_metrics() -> None:
+        from tiktoker.metrics import metrics
+
+        if metrics.is_empty():
+            return
+
+        from structlog.stdlib import get_logger
+
+        metrics.log_summary(get_logger())
+        if path_metrics is not None:
+            metrics.write(Path(path_metrics))
+
+    ctx.call_on_close(report_metrics)
+
+    if profile:
+        from structlog.stdlib import get_logger
+
+        from tiktoker.profiling import start_profiling
+
+        stop_profiling = start_profiling()
+        ctx.call_on_close(lambda: stop_profiling(Path(PROFILE_PATH), get_logger()))
 
 
 @app.command()
 def export_favorites_metadata(
-    session_id: Annotated[
-        str,
-        typer.Option(help="session_id taken from the web version of tiktok's cookies"),
+    session_ids: Annotated[
+        list[str],
+        typer.Option(
+            "--session-id",
+            help="session_id taken from the web version of tiktok's cookies, repeat to export several accounts at once",
+        ),
     ],
+    accounts: Annotated[
+        Optional[list[str]],  # noqa: UP007
+        typer.Option(
+            "--account",
+            help="a name for the account each --session-id belongs to, e.g. its username, so its export is found again after logging in again. Required with several --session-id",
+        ),
+    ] = None,
     path_sqlite: Annotated[
         str,
         typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
@@ -37,19 +83,80 @@ def export_favorites_metadata(
             "--since-export-id", help="only find videos added after the unix timestamp"
         ),
     ] = None,
+    http2: Annotated[
+        bool,
+        typer.Option(help="use HTTP/2 for the tiktok api, requires the h2 package"),
+    ] = False,
+    commit_interval: Annotated[
+        int,
+        typer.Option(
+            min=1,
+            help="number of pages to save per db commit, higher is faster but more is refetched after a crash",
+        ),
+    ] = 1,
+    shard_count: Annotated[
+        int,
+        typer.Option(
+            "--shards",
+            min=1,
+            help="split a new export into this many time ranges and crawl them in parallel",
+        ),
+    ] = 1,
+    api_base_url: Annotated[
+        Optional[str],  # noqa: UP007
+        typer.Option(
+            envvar="TIKTOKER_API_BASE_URL",
+            hidden=True,
+            help="where to send api requests, for benchmarking against a stub server",
+        ),
+    ] = None,
 ) -> None:
+    from tiktoker.commands.export_favorites_metadata import (
+        export_favorites_metadata as export_favorites_metadata_,
+    )
+    from tiktoker.commands.export_favorites_metadata import (
+        export_favorites_metadata_sync_latest,
+    )
+
     if since_export_id is not None:
+        if len(session_ids) > 1:
+            raise typer.BadParameter(
+                "only one --session-id can be synced at a time",
+                param_hint="--since-export-id",
+            )
         export_favorites_metadata_sync_latest(
             export_id=since_export_id,
             path_sqlite=path_sqlite,
             path_video_urls=path_video_urls,
-            session_id=session_id,
+            session_id=session_ids[0],
+            http2=http2,
+            commit_interval=commit_interval,
+            api_base_url=api_base_url,
         )
     else:
+        if accounts is None:
+            if len(session_ids) > 1:
+                raise typer.BadParameter(
+                    "name the account of each --session-id",
+                    param_hint="--account",
+                )
+        elif len(accounts) != len(session_ids):
+            raise typer.BadParameter(
+                "give one --account per --session-id", param_hint="--account"
+            )
+        elif len(set(accounts)) != len(accounts):
+            # the same account twice would crawl its export twice
+            raise typer.BadParameter(
+                "each account can only be exported once", param_hint="--account"
+            )
         export_favorites_metadata_(
-            session_id=session_id,
+            sessions=list(zip(accounts or [None], session_ids, strict=True)),
             path_sqlite=path_sqlite,
             path_video_urls=path_video_urls,
+            http2=http2,
+            commit_interval=commit_interval,
+            shard_count=shard_count,
+            api_base_url=api_base_url,
         )
 
 
@@ -68,12 +175,325 @@ def export_slideshow_images(
         bool,
         typer.Option("--dry-run", help="skip downloading, instead print urls"),
     ] = False,
+    is_enqueue: Annotated[
+        bool,
+        typer.Option(
+            "--enqueue",
+            help="queue the images for `tiktoker worker` instead of downloading them",
+        ),
+    ] = False,
+    concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="number of images to download in parallel"),
+    ] = 8,
+    per_host_concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="max number of parallel downloads from one host"),
+    ] = 4,
 ) -> None:
+    from tiktoker.commands.export_slideshow_images import (
+        export_slideshow_images as export_slideshow_images_,
+    )
+
     export_slideshow_images_(
         export_id=export_id,
         path_sqlite=path_sqlite,
         path_slideshow_dir_path=path_slideshow_dir_path,
         is_dry_run=is_dry_run,
+        is_enqueue=is_enqueue,
+        concurrency=concurrency,
+        per_host_concurrency=per_host_concurrency,
+    )
+
+
+@app.command()
+def download_videos(
+    export_id: Annotated[int, typer.Option(help="id of the export_id")],
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    path_video_dir_path: Annotated[
+        str,
+        typer.Option("--video-dir-path", help="path to save the videos"),
+    ] = "tiktok-videos",
+    is_dry_run: Annotated[
+        bool,
+        typer.Option("--dry-run", help="skip downloading, instead print urls"),
+    ] = False,
+    concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="number of videos to download in parallel"),
+    ] = 8,
+    per_host_concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="max number of parallel downloads from one host"),
+    ] = 4,
+) -> None:
+    """
+    Download videos (and audio for slideshows) using the urls saved in the db.
+    """
+    from tiktoker.commands.download_videos import download_videos as download_videos_
+
+    download_videos_(
+        export_id=export_id,
+        path_sqlite=path_sqlite,
+        path_video_dir_path=path_video_dir_path,
+        is_dry_run=is_dry_run,
+        concurrency=concurrency,
+        per_host_concurrency=per_host_concurrency,
+    )
+
+
+@app.command()
+def daemon(
+    export_id: Annotated[int, typer.Option(help="export to keep in sync")],
+    session_id: Annotated[
+        str,
+        typer.Option(help="session_id taken from the web version of tiktok's cookies"),
+    ],
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    path_slideshow_dir_path: Annotated[
+        str,
+        typer.Option("--image-dir-path", help="path to save the images"),
+    ] = "tiktok-images",
+    path_status: Annotated[
+        str,
+        typer.Option(
+            "--status-path",
+            help="json file updated with the daemon's state and when it last synced",
+        ),
+    ] = "tiktoker-daemon.json",
+    interval_sec: Annotated[
+        float, typer.Option(min=1, help="seconds between syncs")
+    ] = 15 * 60,
+    jitter: Annotated[
+        float,
+        typer.Option(
+            min=0,
+            max=1,
+            help="randomly shorten or lengthen each interval by up to this fraction",
+        ),
+    ] = 0.1,
+    download_images: Annotated[
+        bool,
+        typer.Option(
+            help="download queued slideshow images after each sync, otherwise leave them for `tiktoker worker`"
+        ),
+    ] = True,
+    concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="number of images to download in parallel"),
+    ] = 8,
+    http2: Annotated[
+        bool,
+        typer.Option(help="use HTTP/2 for the tiktok api, requires the h2 package"),
+    ] = False,
+    commit_interval: Annotated[
+        int,
+        typer.Option(
+            min=1,
+            help="number of pages to save per db commit, higher is faster but more is refetched after a crash",
+        ),
+    ] = 1,
+    api_base_url: Annotated[
+        Optional[str],  # noqa: UP007
+        typer.Option(
+            envvar="TIKTOKER_API_BASE_URL",
+            hidden=True,
+            help="where to send api requests, for benchmarking against a stub server",
+        ),
+    ] = None,
+) -> None:
+    """
+    Stay running and sync new favorites into an export every --interval-sec,
+    queueing their slideshow images. Stops after the current sync on SIGTERM.
+    """
+    from tiktoker.commands.daemon import daemon as daemon_
+
+    daemon_(
+        export_id=export_id,
+        session_id=session_id,
+        path_sqlite=path_sqlite,
+        path_slideshow_dir_path=path_slideshow_dir_path,
+        path_status=path_status,
+        interval_sec=interval_sec,
+        jitter=jitter,
+        download_images=download_images,
+        concurrency=concurrency,
+        http2=http2,
+        commit_interval=commit_interval,
+        api_base_url=api_base_url,
+    )
+
+
+@app.command()
+def worker(
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    path_slideshow_dir_path: Annotated[
+        str,
+        typer.Option("--image-dir-path", help="path to save the images"),
+    ] = "tiktok-images",
+    worker_id: Annotated[
+        Optional[str],  # noqa: UP007
+        typer.Option(help="name to lease jobs under, defaults to hostname:pid"),
+    ] = None,
+    concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="number of images to download in parallel"),
+    ] = 8,
+    per_host_concurrency: Annotated[
+        int,
+        typer.Option(min=1, help="max number of parallel downloads from one host"),
+    ] = 4,
+    lease_sec: Annotated[
+        float,
+        typer.Option(
+            min=1,
+            help="how long a claimed job stays ours without a heartbeat before another worker can take it",
+        ),
+    ] = 60,
+    max_attempts: Annotated[
+        int,
+        typer.Option(min=1, help="times to try a job before marking it failed"),
+    ] = 3,
+) -> None:
+    """
+    Download the images queued by `export-slideshow-images --enqueue`. Run as
+    many as you like, on any host that can reach the db file.
+    """
+    from tiktoker.commands.worker import worker as worker_
+
+    worker_(
+        path_sqlite=path_sqlite,
+        path_slideshow_dir_path=path_slideshow_dir_path,
+        worker_id=worker_id,
+        concurrency=concurrency,
+        per_host_concurrency=per_host_concurrency,
+        lease_sec=lease_sec,
+        max_attempts=max_attempts,
+    )
+
+
+@app.command()
+def compact(
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    codec: Annotated[
+        str,
+        typer.Option(
+            help="how to store post json from now on: none, zlib or zstd (requires the zstd extra)"
+        ),
+    ] = "zlib",
+    sample_size: Annotated[
+        int,
+        typer.Option(min=1, help="number of posts used to train the dictionary"),
+    ] = 1000,
+    dict_size: Annotated[
+        int,
+        typer.Option(min=1, help="max size of the trained dictionary in bytes"),
+    ] = 64 * 1024,
+) -> None:
+    """
+    Rewrite the saved post json with the given codec and report the space saved.
+    """
+    from tiktoker.commands.compact import compact as compact_
+    from tiktoker.compression import Codec
+
+    if codec not in get_args(Codec):
+        raise typer.BadParameter(f"unknown codec {codec!r}", param_hint="--codec")
+    compact_(
+        path_sqlite=path_sqlite,
+        codec=cast(Codec, codec),
+        sample_size=sample_size,
+        dict_size=dict_size,
+    )
+
+
+@app.command()
+def export_diff(
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    export_id: Annotated[
+        Optional[int],  # noqa: UP007
+        typer.Option(help="export to compare, defaults to the latest complete one"),
+    ] = None,
+    since_export_id: Annotated[
+        Optional[int],  # noqa: UP007
+        typer.Option(
+            help="export to compare with, defaults to every earlier export of the same account"
+        ),
+    ] = None,
+) -> None:
+    """
+    Print the posts added, removed or changed between exports as ndjson.
+    """
+    from tiktoker.commands.export_diff import export_diff as export_diff_
+
+    export_diff_(
+        path_sqlite=path_sqlite, export_id=export_id, since_export_id=since_export_id
+    )
+
+
+def _parse_after(after: str) -> tuple[float, int]:
+    rank, _, body_id = after.partition(":")
+    try:
+        return float(rank), int(body_id)
+    except ValueError:
+        raise typer.BadParameter(
+            f"expected rank:rowid as printed with the results, got {after!r}",
+            param_hint="--after",
+        ) from None
+
+
+@app.command()
+def search(
+    query: Annotated[
+        str,
+        typer.Argument(
+            help="words to find in the caption, author or hashtags, end a word with * to match prefixes"
+        ),
+    ],
+    path_sqlite: Annotated[
+        str,
+        typer.Option("--sqlite-path", help="path to save the sqlite database on disk"),
+    ] = DEFAULT_SQLITE_PATH,
+    export_id: Annotated[
+        Optional[int],  # noqa: UP007
+        typer.Option(help="only search the posts in this export"),
+    ] = None,
+    limit: Annotated[int, typer.Option(min=1, help="results per page")] = 20,
+    after: Annotated[
+        Optional[str],  # noqa: UP007
+        typer.Option(help="show the page after this one, printed with the results"),
+    ] = None,
+    rebuild: Annotated[
+        bool,
+        typer.Option(help="reindex every saved post before searching"),
+    ] = False,
+) -> None:
+    """
+    Search saved posts, best matches first.
+    """
+    from tiktoker.commands.search import search as search_
+
+    search_(
+        path_sqlite=path_sqlite,
+        query=query,
+        limit=limit,
+        after=_parse_after(after) if after is not None else None,
+        export_id=export_id,
+        rebuild=rebuild,
     )
 
 
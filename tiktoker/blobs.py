@@ -0,0 +1,114 @@
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Self
+
+from tiktoker.metrics import metrics
+
+if TYPE_CHECKING:
+    from _hashlib import HASH
+
+
+@dataclass(slots=True)
+class BlobWriter:
+    _file: IO[bytes]
+    _hasher: "HASH" = field(default_factory=hashlib.sha256)
+    size_bytes: int = 0
+    write_sec: float = 0.0
+
+    def write(self, chunk: bytes) -> None:
+        start = time.perf_counter()
+        self._file.write(chunk)
+        self.write_sec += time.perf_counter() - start
+        self._hasher.update(chunk)
+        self.size_bytes += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class BlobStore:
+    """
+    Files stored once by the sha256 of their content, under `<root>/ab/abcd...`.
+
+    The human readable filenames are hardlinks into the store, so saving the
+    same image for several exports, or under a different description, doesn't
+    take up any more space.
+    """
+
+    _root: Path
+
+    @classmethod
+    def create(cls, root: Path) -> Self:
+        (root / "tmp").mkdir(parents=True, exist_ok=True)
+        return cls(root)
+
+    def path(self, sha256: str) -> Path:
+        return self._root / sha256[:2] / sha256
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).exists()
+
+    @contextmanager
+    def writer(self) -> Generator[BlobWriter, None, None]:
+        """
+        Write a blob without knowing its hash up front. The content goes to a
+        temp file which is renamed into place on success, so the store never
+        has partial files. If the blob is already stored, the copy is dropped.
+
+        Both the file and the rename are synced to disk before returning, so
+        a blob that `exists` after a crash also has all of its content.
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=self._root / "tmp")
+        tmp_path = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = BlobWriter(f)
+                yield writer
+                start = time.perf_counter()
+                f.flush()
+                os.fsync(f.fileno())
+            path = self.path(writer.sha256)
+            if path.exists():
+                tmp_path.unlink()
+            else:
+                path.parent.mkdir(exist_ok=True)
+                tmp_path.replace(path)
+                _fsync_dir(path.parent)
+            metrics.observe(
+                "blob_write", writer.write_sec + time.perf_counter() - start
+            )
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def link(self, sha256: str, dest: Path) -> None:
+        """
+        Point `dest` at a stored blob, replacing whatever is there already.
+
+        Falls back to a symlink when the filesystem can't hardlink, e.g. when
+        `dest` is on another device.
+        """
+        blob = self.path(sha256)
+        tmp_dest = dest.with_name(f".{dest.name}.tmp")
+        tmp_dest.unlink(missing_ok=True)
+        try:
+            tmp_dest.hardlink_to(blob)
+        except OSError:
+            tmp_dest.symlink_to(blob)
+        tmp_dest.replace(dest)
+
+
+def _fsync_dir(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,42 @@
+from structlog.stdlib import get_logger
+
+from tiktoker.compression import Codec, train_dictionary
+from tiktoker.db import DB
+
+
+def compact(
+    *, path_sqlite: str, codec: Codec, sample_size: int, dict_size: int
+) -> None:
+    logger = get_logger()
+    log = logger.bind(codec=codec)
+    log.info("starting")
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
+    size_before = db.size_bytes()
+
+    samples = db.posts.sample_json(limit=sample_size)
+    dictionary = db.compression_dicts.create(
+        codec=codec, data=train_dictionary(codec, samples, size=dict_size)
+    )
+    log.info(
+        "trained dictionary",
+        dict_id=dictionary.id,
+        samples_count=len(samples),
+        dict_size=len(dictionary.data or b""),
+    )
+
+    rewritten_count = db.posts.recompress()
+    log.info("posts rewritten", posts_count=rewritten_count)
+    db.vacuum()
+
+    size_after = db.size_bytes()
+    log.info(
+        "compact complete",
+        size_before=size_before,
+        size_after=size_after,
+        bytes_saved=size_before - size_after,
+    )
+    saved = size_before - size_after
+    print(  # noqa: T201
+        f"{path_sqlite}: {size_before:,} bytes -> {size_after:,} bytes"
+        f" ({saved:,} bytes saved, {saved / max(size_before, 1):.0%})"
+    )
@@ -0,0 +1,165 @@
+import dataclasses
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import FrameType
+from typing import Literal
+
+from structlog.stdlib import get_logger
+
+from tiktoker.commands.export_favorites_metadata import sync_latest
+from tiktoker.commands.export_slideshow_images import (
+    enqueue_slideshow_images,
+    work_slideshow_jobs,
+)
+from tiktoker.db import DB
+from tiktoker.tiktok import TikTok
+
+# for the slideshow images downloaded after each sync, see `tiktoker worker`
+_PER_HOST_CONCURRENCY = 4
+_LEASE_SEC = 60
+_MAX_ATTEMPTS = 3
+
+
+@dataclass(slots=True)
+class _Status:
+    """
+    Written to `--status-path` whenever the daemon changes state, a health
+    check can alert when `last_success_at` gets too old.
+    """
+
+    pid: int
+    export_id: int
+    state: Literal["starting", "syncing", "sleeping", "stopped"] = "starting"
+    started_at: float = dataclasses.field(default_factory=time.time)
+    runs: int = 0
+    failed_runs: int = 0
+    posts_created_total: int = 0
+    images_queued_total: int = 0
+    last_run_at: float | None = None
+    last_success_at: float | None = None
+    last_error: str | None = None
+    next_run_at: float | None = None
+
+    def write(self, path: Path) -> None:
+        # replaced atomically so a health check never reads half of it
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(dataclasses.asdict(self), indent=2) + "\n")
+        tmp_path.replace(path)
+
+
+def daemon(
+    *,
+    export_id: int,
+    session_id: str,
+    path_sqlite: str,
+    path_slideshow_dir_path: str,
+    path_status: str,
+    interval_sec: float,
+    jitter: float,
+    download_images: bool,
+    concurrency: int,
+    http2: bool,
+    commit_interval: int,
+    api_base_url: str | None,
+) -> None:
+    logger = get_logger()
+    log = logger.bind(export_id=export_id)
+    log.info("starting")
+
+    # stop after the current run instead of in the middle of it
+    stopping = threading.Event()
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        if stopping.is_set():
+            # asked twice, don't wait
+            raise KeyboardInterrupt
+        log.info("stopping after the current run", signal=signal.strsignal(signum))
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
+    most_recent_cursor = db.export.get_most_recent_cursor(export_id=export_id)
+    if most_recent_cursor is None:
+        log.warning("export not found", export_id=export_id)
+        sys.exit(1)
+
+    status = _Status(pid=os.getpid(), export_id=export_id)
+    status_path = Path(path_status)
+    status.write(status_path)
+
+    # loaded once and kept up to date by each sync
+    known_post_ids = db.posts.known_ids(export_id=export_id)
+    log.info("loaded known posts", known_posts_count=len(known_post_ids))
+
+    with TikTok.create(
+        log, session_id=session_id, http2=http2, base_url=api_base_url
+    ) as api:
+        while not stopping.is_set():
+            status.state = "syncing"
+            status.runs += 1
+            status.last_run_at = time.time()
+            status.write(status_path)
+            try:
+                posts_created_count = sync_latest(
+                    db,
+                    api,
+                    export_id=export_id,
+                    most_recent_cursor=most_recent_cursor,
+                    known_post_ids=known_post_ids,
+                    commit_interval=commit_interval,
+                    log=log,
+                )
+                status.posts_created_total += posts_created_count
+                if posts_created_count:
+                    status.images_queued_total += enqueue_slideshow_images(
+                        db,
+                        export_id=export_id,
+                        path_slideshow_dir_path=path_slideshow_dir_path,
+                        logger=log,
+                        starting_after=most_recent_cursor,
+                    )
+                most_recent_cursor = (
+                    db.export.get_most_recent_cursor(export_id=export_id)
+                    or most_recent_cursor
+                )
+                if download_images:
+                    work_slideshow_jobs(
+                        db,
+                        path_slideshow_dir_path=path_slideshow_dir_path,
+                        worker_id=f"daemon:{os.getpid()}",
+                        concurrency=concurrency,
+                        per_host_concurrency=min(concurrency, _PER_HOST_CONCURRENCY),
+                        lease_sec=_LEASE_SEC,
+                        max_attempts=_MAX_ATTEMPTS,
+                        logger=log,
+                    )
+            except Exception as e:
+                # keep going, the next run may well work
+                log.exception("sync failed")
+                status.failed_runs += 1
+                status.last_error = repr(e)
+            else:
+                status.last_success_at = time.time()
+                status.last_error = None
+
+            # spread out so several daemons don't all hit the api at once
+            sleep_sec = interval_sec * random.uniform(1 - jitter, 1 + jitter)
+            status.state = "sleeping"
+            status.next_run_at = time.time() + sleep_sec
+            status.write(status_path)
+            log.info("sleeping", sleep_sec=round(sleep_sec, 1))
+            stopping.wait(sleep_sec)
+
+    status.state = "stopped"
+    status.next_run_at = None
+    status.write(status_path)
+    log.info("stopped")
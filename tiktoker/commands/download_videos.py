@@ -0,0 +1,165 @@
+import asyncio
+import glob
+import re
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+import httpx
+from structlog.stdlib import BoundLogger, get_logger
+
+from tiktoker.db import DB, PostVideo
+from tiktoker.http import download_all, download_file, is_expired_url
+from tiktoker.metrics import metrics
+from tiktoker.ratelimit import RateLimiters
+from tiktoker.tiktok import USER_AGENT
+
+# yt-dlp's tiktok extractor cuts the description down to this for the title
+_TITLE_MAX_CHARS = 72
+
+# the video cdn rejects requests that don't look like they came from the site
+_HEADERS = {
+    "User-Agent": USER_AGENT,
+    "Referer": "https://www.tiktok.com/",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class _VideoDownload:
+    url: str
+    filename_stem: str
+    default_extension: str
+    log: BoundLogger
+
+
+def _sanitize_char(char: str) -> str:
+    if char == "\n":
+        return "\0 "
+    if char in '"*:<>?|/\\':
+        # full width lookalikes, slashes get U+29F8 and U+29F9
+        return {"/": "\u29f8", "\\": "\u29f9"}.get(char, chr(ord(char) + 0xFEE0))
+    if ord(char) < 32 or ord(char) == 127:
+        return ""
+    return char
+
+
+def _sanitize(value: str) -> str:
+    """
+    yt-dlp's `sanitize_filename` with its default options, which it applies
+    to every field of the output template.
+    """
+    if not value:
+        return ""
+    # timestamps like 1:23 get underscores instead of lookalike colons
+    value = re.sub(r"[0-9]+(?::[0-9]+)+", lambda m: m.group(0).replace(":", "_"), value)
+    # substitutes are marked with a NUL so runs of them can be collapsed and
+    # trimmed from the ends
+    result = "".join(map(_sanitize_char, value))
+    result = re.sub(r"(\0.)(?:(?=\1)..)+", r"\1", result)
+    strip = r"(?:\0.|[ _-])*"
+    result = re.sub(f"^\0.{strip}|{strip}\0.$", "", result)
+    return result.replace("\0", "") or "_"
+
+
+def _filename_stem(post: PostVideo) -> str:
+    """
+    Same as yt-dlp's `tiktok@%(uploader)s:%(id)s:%(title).100B` template from
+    the README, so files line up with earlier yt-dlp downloads.
+    """
+    title = post.desc
+    if len(title) > _TITLE_MAX_CHARS:
+        title = title[: _TITLE_MAX_CHARS - 3] + "..."
+    title = title or f"TikTok video #{post.id}"
+    # cut to 100 bytes before sanitizing, like yt-dlp
+    title = title.encode()[:100].decode(errors="ignore")
+    return f"tiktok@{_sanitize(post.author)}:{_sanitize(post.id)}:{_sanitize(title)}"
+
+
+def _is_downloaded(dir: Path, filename_stem: str) -> bool:
+    return any(
+        path.suffix != ".part" for path in dir.glob(glob.escape(filename_stem) + ".*")
+    )
+
+
+def _video_downloads(
+    db: DB, dir: Path, *, export_id: int, is_dry_run: bool, logger: BoundLogger
+) -> Iterator[_VideoDownload]:
+    for post in db.posts.videos(export_id=export_id):
+        log = logger.bind(url=post.url, post_id=post.id, author=post.author)
+        filename_stem = _filename_stem(post)
+        if _is_downloaded(dir, filename_stem):
+            log.info("skipping already downloaded video")
+            continue
+        if is_expired_url(post.url):
+            log.warning("skipping expired url")
+            continue
+        if is_dry_run:
+            log.info("would download")
+            continue
+        log.info("downloading")
+        yield _VideoDownload(
+            url=post.url,
+            filename_stem=filename_stem,
+            default_extension=".mp4" if post.is_video else ".mp3",
+            log=log,
+        )
+
+
+def download_videos(
+    *,
+    export_id: int,
+    path_sqlite: str,
+    path_video_dir_path: str,
+    is_dry_run: bool,
+    concurrency: int,
+    per_host_concurrency: int,
+) -> None:
+    logger = get_logger()
+    logger.info("starting...")
+    db = DB.create(path=path_sqlite, log=logger)
+
+    dir = Path(path_video_dir_path).resolve()
+    dir.mkdir(parents=True, exist_ok=True)
+    limiters = RateLimiters()
+
+    async def download(
+        client: httpx.AsyncClient, video: _VideoDownload
+    ) -> str | None | httpx.HTTPError:
+        try:
+            return await download_file(
+                client,
+                url=video.url,
+                path=dir / f"{video.filename_stem}.part",
+                limiters=limiters,
+            )
+        except httpx.HTTPError as e:
+            # e.g. a deleted video, don't let it stop the rest
+            return e
+
+    def save(video: _VideoDownload, res: str | None | httpx.HTTPError) -> None:
+        if isinstance(res, httpx.HTTPError):
+            # any `.part` file is kept so the next run resumes it
+            video.log.warning("download failed", error=str(res))
+            metrics.incr("videos_failed")
+            return
+        path = dir / f"{video.filename_stem}{res or video.default_extension}"
+        (dir / f"{video.filename_stem}.part").rename(path)
+        metrics.incr("videos_saved")
+        video.log.info("downloaded", path=str(path))
+
+    asyncio.run(
+        download_all(
+            _video_downloads(
+                db,
+                dir,
+                export_id=export_id,
+                is_dry_run=is_dry_run,
+                logger=logger,
+            ),
+            download=download,
+            on_result=save,
+            concurrency=concurrency,
+            per_host_concurrency=per_host_concurrency,
+            headers=_HEADERS,
+        )
+    )
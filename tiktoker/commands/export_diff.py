@@ -0,0 +1,63 @@
+import json
+import sys
+from collections import Counter
+
+import structlog
+from structlog.stdlib import get_logger
+
+from tiktoker.db import DB
+
+
+def export_diff(
+    *, path_sqlite: str, export_id: int | None, since_export_id: int | None
+) -> None:
+    # the changes go to stdout as ndjson, keep the logs out of the way
+    structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+    logger = get_logger()
+    db = DB.create(path=path_sqlite, log=logger)
+
+    if export_id is None:
+        latest = db.export.latest_completed()
+        if latest is None:
+            logger.warning("no completed exports found")
+            sys.exit(1)
+        export_id = latest.export_id
+    elif not db.export.is_complete(export_id=export_id):
+        logger.warning(
+            "export isn't complete, posts it hasn't reached yet will show as removed",
+            export_id=export_id,
+        )
+
+    prior_export_ids = (
+        [since_export_id]
+        if since_export_id is not None
+        else db.export.prior_ids(export_id=export_id)
+    )
+    log = logger.bind(export_id=export_id, prior_export_ids=prior_export_ids)
+    if not prior_export_ids:
+        log.warning("no earlier exports to compare with")
+        sys.exit(1)
+
+    counts = Counter[str]()
+    for change in db.posts.diff(export_id=export_id, prior_export_ids=prior_export_ids):
+        counts[change.change] += 1
+        sys.stdout.write(
+            json.dumps(
+                {
+                    "change": change.change,
+                    "post_id": change.id,
+                    "author": change.author,
+                    "desc": change.desc,
+                    "created_at": change.created_at,
+                    "url": f"https://tiktok.com/@{change.author}/video/{change.id}",
+                },
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+    log.info(
+        "diff complete",
+        added_count=counts["added"],
+        removed_count=counts["removed"],
+        changed_count=counts["changed"],
+    )
@@ -1,54 +1,296 @@
+import contextlib
+import itertools
 import sys
 import time
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
 from pathlib import Path
 
 from structlog.stdlib import BoundLogger, get_logger
 
-from tiktoker.db import DB, PostCreateParams
-from tiktoker.tiktok import TikTok
+from tiktoker.db import DB, PostCreateParams, RequestCreateParams
+from tiktoker.pipeline import prefetch, prefetch_many
+from tiktoker.ratelimit import RateLimiters
+from tiktoker.tiktok import FetchResult, RawPost, TikTok
+
+# Number of pages fetched ahead of the page currently being written to the
+# db. Pages are only checkpointed after they're saved so a crash never skips
+# a page that was fetched but not persisted.
+_PREFETCH_PAGES = 2
+
+# Where sharded exports stop crawling. TikTok launched in September 2016 so
+# nothing can have been favorited before then.
+_SHARDED_CREATED_AFTER = 1472688000
+
+
+def _save_page(
+    db: DB,
+    *,
+    export_id: int,
+    fav_batch: FetchResult,
+    posts: Sequence[RawPost],
+) -> int:
+    request_id = db.requests.create(
+        RequestCreateParams(
+            export_id=export_id,
+            http_request_duration_sec=fav_batch.duration_sec,
+            http_request_connect_sec=fav_batch.connect_sec,
+            http_request_tls_sec=fav_batch.tls_sec,
+            http_request_url=fav_batch.request_url,
+            http_request_param_cursor=fav_batch.cursor,
+            http_response_headers_json=dict(fav_batch.response_headers.items()),
+        )
+    )
+    return db.posts.create(
+        [
+            PostCreateParams(
+                export_id=export_id, request_id=request_id, post_json=post.text
+            )
+            for post in posts
+        ]
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class _Crawl:
+    """
+    A time range of one account's favorites, either its whole export or one
+    of the export's shards.
+    """
+
+    export_id: int
+    api: TikTok
+    created_before: int
+    created_after: int | None
+    shard_id: int | None
+
+
+def _crawl(
+    db: DB, crawls: Sequence[_Crawl], *, commit_interval: int, log: BoundLogger
+) -> None:
+    """
+    Fetch each crawl on its own thread and write every page on this one, so
+    there's a single writer and commits are batched across all of them.
+
+    Posts near a shard boundary can show up in both shards and are deduped
+    by `unique_videos_per_export`.
+    """
+    log.info("crawling", crawl_count=len(crawls))
+    with (
+        prefetch_many(
+            [
+                crawl.api.favorites(
+                    created_before=crawl.created_before,
+                    created_after=crawl.created_after,
+                )
+                for crawl in crawls
+            ],
+            maxsize=_PREFETCH_PAGES * len(crawls),
+        ) as fav_batches,
+        db.batched_commits(every=commit_interval) as page_done,
+    ):
+        for crawl_idx, fav_batch in fav_batches:
+            crawl = crawls[crawl_idx]
+            _save_page(
+                db,
+                export_id=crawl.export_id,
+                fav_batch=fav_batch,
+                posts=fav_batch.posts,
+            )
+            if crawl.shard_id is None:
+                db.export.checkpoint(export_id=crawl.export_id, cursor=fav_batch.cursor)
+            else:
+                db.export_shards.checkpoint(
+                    shard_id=crawl.shard_id,
+                    cursor=fav_batch.cursor,
+                    is_complete=fav_batch.is_last,
+                )
+                if fav_batch.is_last:
+                    crawl.api.log.info("shard complete", shard_id=crawl.shard_id)
+            page_done()
 
 
 def export_favorites_metadata(
-    *, session_id: str, path_sqlite: str, path_video_urls: str
+    *,
+    sessions: Sequence[tuple[str | None, str]],
+    path_sqlite: str,
+    path_video_urls: str,
+    http2: bool,
+    commit_interval: int,
+    shard_count: int,
+    api_base_url: str | None,
 ) -> None:
+    """
+    Export the favorites of every (account, session id) in `sessions` at
+    once, each into its own export. The account can only be left out when
+    there's a single session, which resumes whatever export is in progress.
+    """
     logger = get_logger()
-    logger.info("starting")
-    db = DB.create(path=path_sqlite, log=logger)
-    exp = db.export.get_or_create()
+    logger.info("starting", account_count=len(sessions))
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
 
-    log = logger.bind(export_id=exp.export_id)
+    if len(sessions) == 1 and sessions[0][0] is None:
+        in_progress = db.export.in_progress()
+        if len(in_progress) > 1:
+            logger.warning(
+                "several exports in progress, pick one with --account",
+                export_ids=[exp.export_id for exp in in_progress],
+            )
+            sys.exit(1)
 
-    api = TikTok(log, session_id=session_id)
-    for fav_batch in api.favorites(created_before=exp.cursor):
-        posts = [
-            PostCreateParams(
-                http_request_duration_sec=fav_batch.duration_sec,
-                http_request_url=fav_batch.request_url,
-                http_request_param_cursor=fav_batch.cursor,
-                export_id=exp.export_id,
-                http_response_headers_json=dict(fav_batch.response_headers.items()),
-                post_json=post,
+    export_ids = list[int]()
+    crawls = list[_Crawl]()
+    # every session talks to the same host, so they share its request rate
+    limiters = RateLimiters()
+    with contextlib.ExitStack() as stack:
+        for account, session_id in sessions:
+            exp = db.export.get_or_create(account=account)
+            export_ids.append(exp.export_id)
+            log = logger.bind(export_id=exp.export_id, account=account)
+
+            # an export that was started with shards is always resumed with them
+            shards = db.export_shards.get(export_id=exp.export_id)
+            if not shards and shard_count > 1:
+                shards = db.export_shards.create(
+                    export_id=exp.export_id,
+                    created_before=exp.cursor,
+                    created_after=_SHARDED_CREATED_AFTER,
+                    count=shard_count,
+                )
+
+            api = stack.enter_context(
+                TikTok.create(
+                    log,
+                    session_id=session_id,
+                    http2=http2,
+                    rate_limiters=limiters,
+                    max_connections=max(4, len(shards)),
+                    base_url=api_base_url,
+                )
             )
-            for post in fav_batch.posts
-        ]
-        db.posts.create(posts)
-        db.export.checkpoint(export_id=exp.export_id, cursor=fav_batch.cursor)
+            if shards:
+                crawls += [
+                    _Crawl(
+                        export_id=exp.export_id,
+                        api=api,
+                        created_before=shard.cursor,
+                        created_after=shard.created_after,
+                        shard_id=shard.id,
+                    )
+                    for shard in shards
+                    if not shard.is_complete
+                ]
+            else:
+                crawls.append(
+                    _Crawl(
+                        export_id=exp.export_id,
+                        api=api,
+                        created_before=exp.cursor,
+                        created_after=None,
+                        shard_id=None,
+                    )
+                )
 
-    db.export.complete(export_id=exp.export_id)
-    log.info("export complete")
+        _crawl(db, crawls, commit_interval=commit_interval, log=logger)
+
+    for export_id in export_ids:
+        db.export.complete(export_id=export_id)
+        logger.info("export complete", export_id=export_id)
 
-    urls = db.posts.urls(export_id=exp.export_id)
-    _save_urls(urls, path=path_video_urls, log=log, export_id=exp.export_id)
+    urls = itertools.chain.from_iterable(
+        db.posts.urls(export_id=export_id) for export_id in export_ids
+    )
+    _save_urls(urls, path=path_video_urls, log=logger, export_ids=export_ids)
+
+
+def sync_latest(
+    db: DB,
+    api: TikTok,
+    *,
+    export_id: int,
+    most_recent_cursor: int,
+    known_post_ids: set[str],
+    commit_interval: int,
+    log: BoundLogger,
+) -> int:
+    """
+    Save the favorites added since `most_recent_cursor` to the export and
+    return how many there were. `known_post_ids` holds the posts already in
+    the export and is updated with the new ones so it can be reused for the
+    next sync.
+    """
+    starting_cursor = int(time.time())
+    log.info(
+        "found cursor",
+        most_recent_cursor=most_recent_cursor,
+        starting_cursor=starting_cursor,
+    )
+    posts_created_total = 0
+
+    with db.batched_commits(every=commit_interval) as page_done:
+
+        def save(fav_batch: FetchResult) -> bool:
+            """
+            Save the posts we haven't seen before and return whether the next
+            page could have more.
+            """
+            nonlocal posts_created_total
+            if fav_batch.cursor <= most_recent_cursor:
+                log.info("reached previously exported posts", cursor=fav_batch.cursor)
+                return False
+            # posts another export already saved still need a membership row
+            # here, their bodies are shared so that's all they cost
+            new_posts = [
+                post for post in fav_batch.posts if post.id not in known_post_ids
+            ]
+            if new_posts:
+                posts_created_count = _save_page(
+                    db, export_id=export_id, fav_batch=fav_batch, posts=new_posts
+                )
+                log.info("posts created", posts_created_count=posts_created_count)
+                posts_created_total += posts_created_count
+                known_post_ids.update(post.id for post in new_posts)
+                db.export.checkpoint(export_id=export_id, cursor=fav_batch.cursor)
+                page_done()
+            # favorites are newest first, so once a page overlaps with what
+            # we already have, every page after it is already saved
+            if len(new_posts) < len(fav_batch.posts) or fav_batch.is_last:
+                log.info("reached previously exported posts", cursor=fav_batch.cursor)
+                return False
+            return True
+
+        # stops before fetching a page that starts at or before the last sync
+        fav_batches = api.favorites(
+            created_before=starting_cursor, created_after=most_recent_cursor
+        )
+        # usually everything new fits on the first page, so only start
+        # fetching ahead once we know there's more
+        first_batch = next(fav_batches, None)
+        if first_batch is not None and save(first_batch):
+            with prefetch(fav_batches, maxsize=_PREFETCH_PAGES) as rest:
+                for fav_batch in rest:
+                    if not save(fav_batch):
+                        break
+
+    db.export.complete(export_id=export_id)
+    return posts_created_total
 
 
 def export_favorites_metadata_sync_latest(
-    *, export_id: int, path_sqlite: str, path_video_urls: str, session_id: str
+    *,
+    export_id: int,
+    path_sqlite: str,
+    path_video_urls: str,
+    session_id: str,
+    http2: bool,
+    commit_interval: int,
+    api_base_url: str | None,
 ) -> None:
     logger = get_logger()
     log = logger.bind(export_id=export_id)
     log.info("starting")
 
-    db = DB.create(path=path_sqlite, log=logger)
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
 
     exp = db.export.get(export_id=export_id)
     if exp is None:
@@ -60,65 +302,61 @@ def export_favorites_metadata_sync_latest(
         log.warning("export not found", export_id=export_id)
         sys.exit(1)
 
-    starting_cursor = int(time.time())
-
-    log.info(
-        "found cursor",
-        most_recent_cursor=most_recent_cursor,
-        starting_cursor=starting_cursor,
-    )
+    known_post_ids = db.posts.known_ids(export_id=exp.export_id)
+    log.info("loaded known posts", known_posts_count=len(known_post_ids))
 
-    api = TikTok(log, session_id=session_id)
-    for fav_batch in api.favorites(created_before=starting_cursor):
-        posts = [
-            PostCreateParams(
-                http_request_duration_sec=fav_batch.duration_sec,
-                http_request_url=fav_batch.request_url,
-                http_request_param_cursor=fav_batch.cursor,
-                export_id=exp.export_id,
-                http_response_headers_json=dict(fav_batch.response_headers.items()),
-                post_json=post,
-            )
-            for post in fav_batch.posts
-        ]
-        if fav_batch.cursor <= most_recent_cursor:
-            log.info(
-                "reached previously exported posts",
-                export_id=export_id,
-                cursor=fav_batch.cursor,
-            )
-            break
-        posts_created_count = db.posts.create(posts)
-        if not posts_created_count:
-            log.info("no new posts created")
-            break
-        log.info("posts created", posts_created_count=posts_created_count)
-        db.export.checkpoint(export_id=exp.export_id, cursor=fav_batch.cursor)
-
-    db.export.complete(export_id=exp.export_id)
+    with TikTok.create(
+        log, session_id=session_id, http2=http2, base_url=api_base_url
+    ) as api:
+        sync_latest(
+            db,
+            api,
+            export_id=exp.export_id,
+            most_recent_cursor=most_recent_cursor,
+            known_post_ids=known_post_ids,
+            commit_interval=commit_interval,
+            log=log,
+        )
     log.info("export complete")
 
     urls = db.posts.urls(export_id=exp.export_id, starting_after=most_recent_cursor)
-    _save_urls(urls, path=path_video_urls, log=log, export_id=exp.export_id)
+    _save_urls(urls, path=path_video_urls, log=log, export_ids=[exp.export_id])
 
 
-def _save_urls(urls: list[str], *, path: str, log: BoundLogger, export_id: int) -> None:
-    Path(path).write_text("\n".join(urls))
+def _save_urls(
+    urls: Iterable[str], *, path: str, log: BoundLogger, export_ids: Sequence[int]
+) -> None:
+    urls_count = 0
+    with Path(path).open("w") as f:
+        for url in urls:
+            f.write(url + "\n")
+            urls_count += 1
     log.info(
         "urls saved",
-        urls_count=len(urls),
+        urls_count=urls_count,
         video_urls_path=path,
     )
+    download_videos = "\n    ".join(
+        f"tiktoker download-videos --export-id={export_id}" for export_id in export_ids
+    )
+    export_slideshow_images = "\n    ".join(
+        f"tiktoker export-slideshow-images --export-id={export_id}"
+        for export_id in export_ids
+    )
     print(  # noqa: T201
         f"""
 Next Steps:
 
 1. Download videos (and audio for slideshows)
 
+    {download_videos}
+
+   or with yt-dlp
+
     yt-dlp -o "tiktok-videos/tiktok@%(uploader)s:%(id)s:%(title).100B.%(ext)s" -a {path}
 
 2. Download images for slideshows
 
-    tiktoker export-slideshow-images --export-id={export_id}
+    {export_slideshow_images}
 """
     )
@@ -1,17 +1,247 @@
+import asyncio
+import functools
+import itertools
+import time
+from collections.abc import Callable, Iterator, Sequence
+from dataclasses import dataclass, field
 from datetime import UTC, datetime
 from pathlib import Path
-from urllib.parse import parse_qs, urlparse
 
-from structlog.stdlib import get_logger
+import httpx
+from structlog.stdlib import BoundLogger, get_logger
 
-from tiktoker.db import DB
-from tiktoker.http import download_image
+from tiktoker.blobs import BlobStore
+from tiktoker.db import DB, Job, JobCreateParams, JobStatus, MediaSaveParams
+from tiktoker.http import (
+    BlobResult,
+    download_all,
+    download_blob,
+    is_expired_url,
+    url_expires_at,
+)
+from tiktoker.metrics import metrics
+from tiktoker.ratelimit import RateLimiters
 
+# saved images are recorded in the db together, at most this many or this
+# often, see `DB.deferred_writes`
+_COMMIT_EVERY = 50
+_COMMIT_INTERVAL_SEC = 2.0
 
-def _is_expired_url(url: str) -> bool:
-    query_params = parse_qs(urlparse(url).query)
-    expires_at = datetime.fromtimestamp(int(query_params["x-expires"][0]), tz=UTC)
-    return expires_at < datetime.now(tz=UTC)
+# kept inside the image dir so the filenames can be hardlinks
+_BLOB_DIR_NAME = ".blobs"
+
+# how often to estimate how many urls will expire before we get to them
+_REPORT_INTERVAL_SEC = 30.0
+
+
+@dataclass(frozen=True, slots=True)
+class _SlideDownload:
+    url: str
+    post_id: str
+    slide_index: int
+    filename_stem: str
+    expires_at: datetime | None
+    log: BoundLogger
+
+
+def _soonest_expiry_first(slide: _SlideDownload) -> tuple[bool, datetime | None]:
+    # urls without an expiry go last, they'll still work when we get there
+    return (slide.expires_at is None, slide.expires_at)
+
+
+def _pending_slides(
+    db: DB,
+    store: BlobStore,
+    *,
+    export_id: int,
+    is_dry_run: bool,
+    logger: BoundLogger,
+    starting_after: int | None = None,
+) -> list[_SlideDownload]:
+    """
+    Every slide of the export that still needs downloading, soonest expiring
+    first so a long run gets to the short lived urls while they still work.
+    """
+    completed = db.media.completed()
+    skipped_count = 0
+    pending = list[_SlideDownload]()
+    for post in db.posts.slideshows(export_id=export_id, starting_after=starting_after):
+        image_count = len(post.images)
+        padding = len(str(image_count))
+        for idx, url in enumerate(post.images, start=1):
+            log = logger.bind(url=url, post_id=post.id, author=post.author)
+            saved = completed.get((post.id, idx))
+            if saved is not None and store.exists(saved.sha256):
+                if not is_dry_run and not Path(saved.path).exists():
+                    log.info("relinking deleted image", path=saved.path)
+                    store.link(saved.sha256, Path(saved.path))
+                skipped_count += 1
+                continue
+            pending.append(
+                _SlideDownload(
+                    url=url,
+                    post_id=post.id,
+                    slide_index=idx,
+                    filename_stem=f"tiktok@{post.author}:{post.id}:slide-{idx:0{padding}}-of-{image_count}:{post.desc[:80]}",
+                    expires_at=url_expires_at(url),
+                    log=log,
+                )
+            )
+    logger.info("skipped already downloaded images", skipped_count=skipped_count)
+    pending.sort(key=_soonest_expiry_first)
+    return pending
+
+
+@dataclass(slots=True)
+class _ExpiryRisk:
+    """
+    Estimates how many of the remaining slides will expire before we get to
+    them at the throughput seen so far.
+
+    Slides are downloaded in order, so the one `n` places after the last one
+    handed to the downloader starts in about `n / throughput` seconds.
+    """
+
+    _expiries: Sequence[float | None]
+    _log: BoundLogger
+    _start: float = field(default_factory=time.monotonic)
+    _last_report: float = field(default_factory=time.monotonic)
+    # slides handed to the downloader or skipped
+    _queued: int = 0
+    # slides downloaded, successfully or not
+    _done: int = 0
+
+    @classmethod
+    def create(
+        cls, slides: Sequence[_SlideDownload], log: BoundLogger
+    ) -> "_ExpiryRisk":
+        return cls(
+            _expiries=[
+                s.expires_at.timestamp() if s.expires_at is not None else None
+                for s in slides
+            ],
+            _log=log,
+        )
+
+    def at_risk_count(self, images_per_sec: float) -> int:
+        now = datetime.now(tz=UTC).timestamp()
+        count = 0
+        remaining = itertools.islice(self._expiries, self._queued, None)
+        for position, expires_at in enumerate(remaining):
+            if expires_at is None:
+                # the rest don't expire either
+                break
+            if expires_at < now + position / images_per_sec:
+                count += 1
+        return count
+
+    def queued(self) -> None:
+        self._queued += 1
+
+    def done(self) -> None:
+        self._done += 1
+        now = time.monotonic()
+        if now - self._last_report < _REPORT_INTERVAL_SEC:
+            return
+        self._last_report = now
+        images_per_sec = self._done / (now - self._start)
+        self._log.info(
+            "download progress",
+            done_count=self._done,
+            remaining_count=len(self._expiries) - self._queued,
+            images_per_sec=round(images_per_sec, 2),
+            at_risk_count=self.at_risk_count(images_per_sec),
+        )
+
+
+def _expired(slide: _SlideDownload) -> MediaSaveParams:
+    slide.log.warning("skipping expired url")
+    metrics.incr("images_expired")
+    return MediaSaveParams(
+        post_id=slide.post_id,
+        slide_index=slide.slide_index,
+        url=slide.url,
+        status="expired",
+    )
+
+
+def _slide_downloads(
+    db: DB,
+    slides: Sequence[_SlideDownload],
+    *,
+    defer: Callable[[Callable[[], None]], None],
+    risk: _ExpiryRisk,
+    is_dry_run: bool,
+) -> Iterator[_SlideDownload]:
+    # consumed lazily by the downloader, so expiry is checked again right
+    # before each slide is handed over
+    for slide in slides:
+        risk.queued()
+        if is_expired_url(slide.url):
+            if not is_dry_run:
+                defer(functools.partial(db.media.save, _expired(slide)))
+            continue
+        if is_dry_run:
+            slide.log.info("would download", expires_at=slide.expires_at)
+            continue
+        slide.log.info("downloading")
+        yield slide
+
+
+async def _download(
+    client: httpx.AsyncClient,
+    slide: _SlideDownload,
+    *,
+    store: BlobStore,
+    limiters: RateLimiters,
+) -> BlobResult | httpx.HTTPError:
+    try:
+        return await download_blob(
+            client, url=slide.url, store=store, limiters=limiters
+        )
+    except httpx.HTTPError as e:
+        return e
+
+
+def _save(
+    slide: _SlideDownload,
+    res: BlobResult | httpx.HTTPError,
+    *,
+    dir: Path,
+    store: BlobStore,
+) -> MediaSaveParams:
+    """
+    Link a downloaded image into place, returns the row to record for it.
+    """
+    if isinstance(res, httpx.HTTPError):
+        slide.log.warning("download failed", error=str(res))
+        return MediaSaveParams(
+            post_id=slide.post_id,
+            slide_index=slide.slide_index,
+            url=slide.url,
+            status="failed",
+            error=str(res),
+        )
+    path = dir / f"{slide.filename_stem}{res.extension or ''}"
+    store.link(res.sha256, path)
+    metrics.incr("images_saved")
+    metrics.incr("image_bytes", res.size_bytes)
+    slide.log.info("downloaded")
+    return MediaSaveParams(
+        post_id=slide.post_id,
+        slide_index=slide.slide_index,
+        url=slide.url,
+        status="complete",
+        path=str(path),
+        size_bytes=res.size_bytes,
+        sha256=res.sha256,
+    )
+
+
+def _image_dir(path_slideshow_dir_path: str) -> tuple[Path, BlobStore]:
+    dir = Path(path_slideshow_dir_path).resolve()
+    dir.mkdir(parents=True, exist_ok=True)
+    return dir, BlobStore.create(dir / _BLOB_DIR_NAME)
 
 
 def export_slideshow_images(
@@ -19,25 +249,228 @@ def export_slideshow_images(
     path_sqlite: str,
     path_slideshow_dir_path: str,
     is_dry_run: bool,
+    is_enqueue: bool,
+    concurrency: int,
+    per_host_concurrency: int,
 ) -> None:
     logger = get_logger()
     logger.info("starting...")
-    db = DB.create(path=path_sqlite, log=logger)
-    for post in db.posts.slideshows(export_id=export_id):
-        image_count = len(post.images)
-        padding = len(str(image_count))
-        for idx, url in enumerate(post.images, start=1):
-            log = logger.bind(url=url, post_id=post.id, author=post.author)
-            if _is_expired_url(url):
-                log.warning("skipping expired url")
-                continue
-            if is_dry_run:
-                log.info("would download")
-                continue
-            log.info("downloading")
-            res = download_image(url=url)
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
+
+    if is_enqueue:
+        enqueue_slideshow_images(
+            db,
+            export_id=export_id,
+            path_slideshow_dir_path=path_slideshow_dir_path,
+            logger=logger,
+        )
+        return
+
+    dir, store = _image_dir(path_slideshow_dir_path)
+    limiters = RateLimiters()
+
+    slides = _pending_slides(
+        db, store, export_id=export_id, is_dry_run=is_dry_run, logger=logger
+    )
+    expiring = [s.expires_at for s in slides if s.expires_at is not None]
+    logger.info(
+        "scheduled downloads",
+        pending_count=len(slides),
+        soonest_expires_at=min(expiring, default=None),
+        latest_expires_at=max(expiring, default=None),
+    )
+    risk = _ExpiryRisk.create(slides, logger)
+
+    with db.deferred_writes(
+        every=_COMMIT_EVERY, interval_sec=_COMMIT_INTERVAL_SEC
+    ) as defer:
+
+        def save(slide: _SlideDownload, res: BlobResult | httpx.HTTPError) -> None:
+            params = _save(slide, res, dir=dir, store=store)
+            defer(functools.partial(db.media.save, params))
+            risk.done()
+
+        asyncio.run(
+            download_all(
+                _slide_downloads(
+                    db, slides, defer=defer, risk=risk, is_dry_run=is_dry_run
+                ),
+                download=lambda client, slide: _download(
+                    client, slide, store=store, limiters=limiters
+                ),
+                on_result=save,
+                concurrency=concurrency,
+                per_host_concurrency=per_host_concurrency,
+            )
+        )
+
+
+def enqueue_slideshow_images(
+    db: DB,
+    *,
+    export_id: int,
+    path_slideshow_dir_path: str,
+    logger: BoundLogger,
+    starting_after: int | None = None,
+) -> int:
+    """
+    Queue the export's slides that still need downloading for `tiktoker
+    worker`, returns how many were queued. `starting_after` only looks at
+    posts found since that cursor, see `PostTable.slideshows`.
+    """
+    _, store = _image_dir(path_slideshow_dir_path)
+    slides = _pending_slides(
+        db,
+        store,
+        export_id=export_id,
+        is_dry_run=False,
+        logger=logger,
+        starting_after=starting_after,
+    )
+    db.jobs.enqueue(
+        [
+            JobCreateParams(
+                post_id=slide.post_id,
+                slide_index=slide.slide_index,
+                url=slide.url,
+                filename_stem=slide.filename_stem,
+                expires_at=int(slide.expires_at.timestamp())
+                if slide.expires_at is not None
+                else None,
+            )
+            for slide in slides
+        ]
+    )
+    logger.info("queued slideshow images", export_id=export_id, jobs_count=len(slides))
+    return len(slides)
+
+
+@dataclass(frozen=True, slots=True)
+class _LeasedSlide:
+    job: Job
+    slide: _SlideDownload
+
+    @property
+    def url(self) -> str:
+        return self.slide.url
+
+
+def _finish_job(
+    db: DB,
+    job: Job,
+    *,
+    owner: str,
+    status: JobStatus,
+    params: MediaSaveParams | None,
+    log: BoundLogger,
+    error: str | None = None,
+) -> None:
+    if params is not None:
+        db.media.save(params)
+    if not db.jobs.finish(job_id=job.id, owner=owner, status=status, error=error):
+        log.warning("lease lost, another worker took the job")
+
+
+def work_slideshow_jobs(
+    db: DB,
+    *,
+    path_slideshow_dir_path: str,
+    worker_id: str,
+    concurrency: int,
+    per_host_concurrency: int,
+    lease_sec: float,
+    max_attempts: int,
+    logger: BoundLogger,
+) -> None:
+    """
+    Download queued slides until there are none left to claim.
+
+    Jobs are claimed a few at a time as the downloader needs them and their
+    leases are extended every `lease_sec / 3` while this runs. If the worker
+    dies, its jobs go back to the queue once their leases run out.
+    """
+    log = logger.bind(worker_id=worker_id)
+    dir, store = _image_dir(path_slideshow_dir_path)
+    limiters = RateLimiters()
+
+    def claimed(defer: Callable[[Callable[[], None]], None]) -> Iterator[_LeasedSlide]:
+        while jobs := db.jobs.claim(
+            owner=worker_id, limit=concurrency, lease_sec=lease_sec
+        ):
+            for job in jobs:
+                slide = _SlideDownload(
+                    url=job.url,
+                    post_id=job.post_id,
+                    slide_index=job.slide_index,
+                    filename_stem=job.filename_stem,
+                    expires_at=url_expires_at(job.url),
+                    log=log.bind(url=job.url, post_id=job.post_id, job_id=job.id),
+                )
+                if is_expired_url(job.url):
+                    defer(
+                        functools.partial(
+                            _finish_job,
+                            db,
+                            job,
+                            owner=worker_id,
+                            status="expired",
+                            params=_expired(slide),
+                            log=slide.log,
+                        )
+                    )
+                    continue
+                slide.log.info("downloading", attempt=job.attempts)
+                yield _LeasedSlide(job=job, slide=slide)
+
+    with db.deferred_writes(
+        every=_COMMIT_EVERY, interval_sec=_COMMIT_INTERVAL_SEC
+    ) as defer:
+
+        def save(leased: _LeasedSlide, res: BlobResult | httpx.HTTPError) -> None:
+            job = leased.job
+            status: JobStatus
+            params: MediaSaveParams | None = None
+            if isinstance(res, httpx.HTTPError) and job.attempts < max_attempts:
+                leased.slide.log.warning(
+                    "download failed, will retry", error=str(res), attempt=job.attempts
+                )
+                status = "pending"
+            else:
+                params = _save(leased.slide, res, dir=dir, store=store)
+                status = "failed" if isinstance(res, httpx.HTTPError) else "complete"
+            defer(
+                functools.partial(
+                    _finish_job,
+                    db,
+                    job,
+                    owner=worker_id,
+                    status=status,
+                    params=params,
+                    error=str(res) if isinstance(res, httpx.HTTPError) else None,
+                    log=leased.slide.log,
+                )
+            )
+
+        async def run() -> None:
+            async def heartbeat() -> None:
+                while True:
+                    await asyncio.sleep(lease_sec / 3)
+                    db.jobs.heartbeat(owner=worker_id, lease_sec=lease_sec)
+
+            heartbeat_task = asyncio.create_task(heartbeat())
+            try:
+                await download_all(
+                    claimed(defer),
+                    download=lambda client, leased: _download(
+                        client, leased.slide, store=store, limiters=limiters
+                    ),
+                    on_result=save,
+                    concurrency=concurrency,
+                    per_host_concurrency=per_host_concurrency,
+                )
+            finally:
+                heartbeat_task.cancel()
+
+        asyncio.run(run())
 
-            dir = Path(path_slideshow_dir_path).resolve()
-            dir.mkdir(parents=True, exist_ok=True)
-            filename = f"tiktok@{post.author}:{post.id}:slide-{idx:0{padding}}-of-{image_count}:{post.desc[:80]}{res.extension}"
-            (dir / filename).write_bytes(res.content)
+    log.info("no more jobs to claim", **db.jobs.counts())
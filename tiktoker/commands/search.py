@@ -0,0 +1,45 @@
+import time
+from datetime import UTC, datetime
+
+from structlog.stdlib import get_logger
+
+from tiktoker.db import DB
+
+
+def search(
+    *,
+    path_sqlite: str,
+    query: str,
+    limit: int,
+    after: tuple[float, int] | None,
+    export_id: int | None,
+    rebuild: bool,
+) -> None:
+    logger = get_logger()
+    db = DB.create(path=path_sqlite, log=logger)
+    if rebuild:
+        db.search.rebuild()
+
+    start = time.perf_counter()
+    results = db.search.search(
+        query,
+        limit=limit,
+        after=after,
+        export_id=export_id,
+    )
+    duration_ms = (time.perf_counter() - start) * 1000
+
+    for result in results:
+        created_at = (
+            datetime.fromtimestamp(result.created_at, tz=UTC).date().isoformat()
+            if result.created_at is not None
+            else "?"
+        )
+        print(  # noqa: T201
+            f"{created_at}  https://tiktok.com/@{result.author}/video/{result.post_id}  {result.snippet}"
+        )
+    summary = f"{len(results)} results in {duration_ms:.1f}ms"
+    if len(results) == limit:
+        last = results[-1]
+        summary += f", next page: --after={last.rank!r}:{last.body_id}"
+    print(summary)  # noqa: T201
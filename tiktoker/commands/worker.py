@@ -0,0 +1,32 @@
+import os
+import socket
+
+from structlog.stdlib import get_logger
+
+from tiktoker.commands.export_slideshow_images import work_slideshow_jobs
+from tiktoker.db import DB
+
+
+def worker(
+    *,
+    path_sqlite: str,
+    path_slideshow_dir_path: str,
+    worker_id: str | None,
+    concurrency: int,
+    per_host_concurrency: int,
+    lease_sec: float,
+    max_attempts: int,
+) -> None:
+    logger = get_logger()
+    logger.info("starting...")
+    db = DB.create(path=path_sqlite, log=logger, write_mode=True)
+    work_slideshow_jobs(
+        db,
+        path_slideshow_dir_path=path_slideshow_dir_path,
+        worker_id=worker_id or f"{socket.gethostname()}:{os.getpid()}",
+        concurrency=concurrency,
+        per_host_concurrency=per_host_concurrency,
+        lease_sec=lease_sec,
+        max_attempts=max_attempts,
+        logger=logger,
+    )
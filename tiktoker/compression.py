@@ -0,0 +1,147 @@
+import struct
+import zlib
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    from zstandard import ZstdCompressor, ZstdDecompressor
+
+try:
+    import zstandard
+except ImportError:  # optional, see the `zstd` extra
+    zstandard = None
+
+Codec = Literal["none", "zlib", "zstd"]
+
+# compressed values are stored as a blob of: dictionary id + payload
+_HEADER = struct.Struct(">I")
+
+# zlib only looks back 32 KiB so a bigger preset dictionary is wasted
+_ZLIB_MAX_DICT_SIZE = 32 * 1024
+
+
+@dataclass(frozen=True, slots=True)
+class Dictionary:
+    id: int
+    codec: Codec
+    data: bytes | None
+
+
+def train_dictionary(
+    codec: Codec, samples: Sequence[bytes], *, size: int
+) -> bytes | None:
+    """
+    Build a shared dictionary from sample post payloads. TikTok items repeat
+    the same keys and a lot of the same values so even small dictionaries
+    help a lot.
+    """
+    if codec == "none" or not samples:
+        return None
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("the zstd codec requires the zstandard package")
+        return zstandard.train_dictionary(size, list(samples)).as_bytes()
+    # zlib has no trainer, but it finds matches in the preset dictionary so a
+    # handful of real payloads does the job. The end of the dictionary is
+    # the cheapest to reference so the samples go last.
+    return b"".join(samples)[-min(size, _ZLIB_MAX_DICT_SIZE) :]
+
+
+@dataclass(slots=True)
+class PostJsonCompressor:
+    """
+    Converts between the `post_json` text and what's stored in the db. Plain
+    text is stored as is, compressed payloads are blobs prefixed with the id
+    of the `tiktok_compression_dicts` row needed to decompress them.
+    """
+
+    _dicts: dict[int, Dictionary] = field(default_factory=dict[int, Dictionary])
+    _current: Dictionary | None = None
+    _zstd_compressor: "ZstdCompressor | None" = None
+    _zstd_decompressors: "dict[int, ZstdDecompressor]" = field(
+        default_factory=dict[int, "ZstdDecompressor"]
+    )
+    # sqlite calls `decompress` once per generated column on insert, so
+    # remember the last payload.
+    _last: tuple[bytes, str] | None = None
+    # loads the dictionaries again when a payload needs one we don't have,
+    # e.g. `compact` added it from another process after we loaded them
+    reload: Callable[[], None] | None = None
+
+    @property
+    def codec(self) -> Codec:
+        return "none" if self._current is None else self._current.codec
+
+    def add(self, dictionary: Dictionary, *, current: bool) -> None:
+        self._dicts[dictionary.id] = dictionary
+        if current:
+            self._current = dictionary
+            self._zstd_compressor = None
+
+    def compress(self, text: str) -> str | bytes:
+        current = self._current
+        if current is None or current.codec == "none":
+            return text
+        data = text.encode()
+        if current.codec == "zlib":
+            compressor = (
+                zlib.compressobj(level=9, zdict=current.data)
+                if current.data
+                else zlib.compressobj(level=9)
+            )
+            payload = compressor.compress(data) + compressor.flush()
+        else:
+            if zstandard is None:
+                raise RuntimeError("the zstd codec requires the zstandard package")
+            if self._zstd_compressor is None:
+                self._zstd_compressor = zstandard.ZstdCompressor(
+                    level=19,
+                    dict_data=zstandard.ZstdCompressionDict(current.data)
+                    if current.data
+                    else None,
+                )
+            payload = self._zstd_compressor.compress(data)
+        return _HEADER.pack(current.id) + payload
+
+    def _dictionary(self, dict_id: int) -> Dictionary:
+        dictionary = self._dicts.get(dict_id)
+        if dictionary is None and self.reload is not None:
+            self.reload()
+            dictionary = self._dicts.get(dict_id)
+        if dictionary is None:
+            raise RuntimeError(
+                f"compression dictionary {dict_id} not found in tiktok_compression_dicts"
+            )
+        return dictionary
+
+    def decompress(self, value: str | bytes) -> str:
+        if isinstance(value, str):
+            return value
+        if self._last is not None and self._last[0] == value:
+            return self._last[1]
+        (dict_id,) = _HEADER.unpack_from(value)
+        payload = value[_HEADER.size :]
+        dictionary = self._dictionary(dict_id)
+        if dictionary.codec == "zlib":
+            decompressor = (
+                zlib.decompressobj(zdict=dictionary.data)
+                if dictionary.data
+                else zlib.decompressobj()
+            )
+            data = decompressor.decompress(payload) + decompressor.flush()
+        else:
+            if zstandard is None:
+                raise RuntimeError("the zstd codec requires the zstandard package")
+            zstd_decompressor = self._zstd_decompressors.get(dict_id)
+            if zstd_decompressor is None:
+                zstd_decompressor = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary.data)
+                    if dictionary.data
+                    else None
+                )
+                self._zstd_decompressors[dict_id] = zstd_decompressor
+            data = zstd_decompressor.decompress(payload)
+        text = data.decode()
+        self._last = (value, text)
+        return text
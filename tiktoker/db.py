@@ -1,12 +1,27 @@
+import hashlib
+import itertools
 import json
 import sqlite3
 import time
-from collections.abc import Sequence
+from collections.abc import Callable, Generator, Iterator, Sequence
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Literal
 
 from structlog.stdlib import BoundLogger
 
+from tiktoker.compression import Codec, Dictionary, PostJsonCompressor
+from tiktoker.metrics import metrics
+from tiktoker.migrations import migrate
+
+# rows fetched from sqlite at a time when streaming query results
+_FETCH_SIZE = 500
+
+
+def _iter_rows(cur: sqlite3.Cursor) -> Iterator[Any]:
+    while rows := cur.fetchmany(_FETCH_SIZE):
+        yield from rows
+
 
 @dataclass(frozen=True, slots=True)
 class Export:
@@ -19,21 +34,40 @@ class ExportTable:
     _conn: sqlite3.Connection
     _log: BoundLogger
 
-    def _get_current(self) -> Export | None:
+    def _get_current(self, *, account: str | None) -> Export | None:
         cur = self._conn.cursor()
         result = cur.execute(
             """
 select id, cursor 
 from tiktok_export 
-where completed_at is null 
+where
+    completed_at is null
+    and (:account is null or account = :account)
+order by id
 limit 1;
-        """
+        """,
+            {"account": account},
         ).fetchone()
         if result is None:
             return None
         export_id, cursor = result
         return Export(export_id=export_id, cursor=cursor)
 
+    def in_progress(self) -> list[Export]:
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select id, cursor
+from tiktok_export
+where completed_at is null
+order by id;
+        """
+        )
+        return [
+            Export(export_id=export_id, cursor=cursor)
+            for export_id, cursor in cur.fetchall()
+        ]
+
     def get(self, *, export_id: int) -> Export | None:
         cur = self._conn.cursor()
         result = cur.execute(
@@ -50,6 +84,54 @@ limit 1;
         export_id, cursor = result
         return Export(export_id=export_id, cursor=cursor)
 
+    def latest_completed(self) -> Export | None:
+        cur = self._conn.cursor()
+        result = cur.execute(
+            """
+select id, cursor
+from tiktok_export
+where completed_at is not null
+order by id desc
+limit 1;
+        """
+        ).fetchone()
+        if result is None:
+            return None
+        export_id, cursor = result
+        return Export(export_id=export_id, cursor=cursor)
+
+    def is_complete(self, *, export_id: int) -> bool:
+        cur = self._conn.cursor()
+        result = cur.execute(
+            """
+select completed_at is not null from tiktok_export where id = :export_id;
+        """,
+            {"export_id": export_id},
+        ).fetchone()
+        return result is not None and bool(result[0])
+
+    def prior_ids(self, *, export_id: int) -> list[int]:
+        """
+        Exports of the same account started before this one, including ones
+        from before accounts were recorded.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select id
+from tiktok_export
+where
+    id < :export_id
+    and (
+        account is null
+        or account = (select account from tiktok_export where id = :export_id)
+    )
+order by id;
+        """,
+            {"export_id": export_id},
+        )
+        return [export_id for (export_id,) in cur.fetchall()]
+
     def get_most_recent_cursor(self, *, export_id: int) -> int | None:
         cur = self._conn.cursor()
         result = cur.execute(
@@ -57,9 +139,13 @@ limit 1;
 SELECT
   max(http_request_param_cursor)
 FROM
-  tiktok_posts
+  tiktok_requests
 WHERE
   export_id = :export_id
+  -- ignore fetches where every post was already saved
+  AND EXISTS (
+    SELECT 1 FROM tiktok_posts WHERE tiktok_posts.request_id = tiktok_requests.id
+  )
 LIMIT 1;
         """,
             {"export_id": export_id},
@@ -69,8 +155,36 @@ LIMIT 1;
         (cursor,) = result
         return cursor
 
-    def get_or_create(self) -> Export:
-        export = self._get_current()
+    def get_or_create(self, *, account: str | None) -> Export:
+        """
+        The account's export in progress, or a new one. An export from before
+        accounts were recorded is resumed by the first account to ask.
+
+        Without an account, any export in progress is resumed, see
+        `in_progress` to check there's only one.
+        """
+        cur = self._conn.cursor()
+        if account is not None:
+            cur.execute(
+                """
+update tiktok_export
+set account = :account
+where
+    id = (
+        select id from tiktok_export
+        where completed_at is null and account is null
+        limit 1
+    )
+    and not exists (
+        select 1 from tiktok_export
+        where completed_at is null and account = :account
+    );
+            """,
+                {"account": account},
+            )
+            self._conn.commit()
+
+        export = self._get_current(account=account)
         if export is not None:
             self._log.info(
                 "found export in progress",
@@ -80,16 +194,16 @@ LIMIT 1;
             return export
         self._log.info("no incomplete export found. creating...")
         cursor = int(time.time())
-        cur = self._conn.cursor()
         cur.execute(
             """
-insert into tiktok_export(cursor) values (:cursor);
+insert into tiktok_export(cursor, account) values (:cursor, :account);
         """,
-            {"cursor": cursor},
+            {"cursor": cursor, "account": account},
         )
         self._conn.commit()
 
-        export = self._get_current()
+        assert cur.lastrowid is not None
+        export = self.get(export_id=cur.lastrowid)
         assert export is not None, "we should have saved a batch right before this"
         self._log.info(
             "created export", export_id=export.export_id, cursor=export.cursor
@@ -111,6 +225,10 @@ where id = :export_id
         self._conn.commit()
 
     def checkpoint(self, *, export_id: int, cursor: int) -> None:
+        """
+        Doesn't commit, the checkpoint should be committed in the same
+        transaction as the page of posts it covers, see `DB.batched_commits`.
+        """
         cur = self._conn.cursor()
         cur.execute(
             """
@@ -123,26 +241,167 @@ where id = :export_id
                 "cursor": cursor,
             },
         )
+
+
+@dataclass(frozen=True, slots=True)
+class ExportShard:
+    id: int
+    created_before: int
+    created_after: int
+    cursor: int
+    is_complete: bool
+
+
+@dataclass(frozen=True, slots=True)
+class ExportShardTable:
+    _conn: sqlite3.Connection
+    _log: BoundLogger
+
+    def get(self, *, export_id: int) -> list[ExportShard]:
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select id, created_before, created_after, cursor, completed_at is not null
+from tiktok_export_shards
+where export_id = :export_id
+order by created_before desc;
+        """,
+            {"export_id": export_id},
+        )
+        return [
+            ExportShard(
+                id=shard_id,
+                created_before=created_before,
+                created_after=created_after,
+                cursor=cursor,
+                is_complete=bool(is_complete),
+            )
+            for shard_id, created_before, created_after, cursor, is_complete in (
+                cur.fetchall()
+            )
+        ]
+
+    def create(
+        self, *, export_id: int, created_before: int, created_after: int, count: int
+    ) -> list[ExportShard]:
+        """
+        Split `created_after` to `created_before` into `count` equal time
+        ranges.
+        """
+        step = (created_before - created_after) / count
+        bounds = [created_after + round(step * idx) for idx in range(count)]
+        bounds.append(created_before)
+        cur = self._conn.cursor()
+        cur.executemany(
+            """
+insert into tiktok_export_shards(export_id, created_before, created_after, cursor)
+values (:export_id, :created_before, :created_after, :created_before);
+        """,
+            [
+                {
+                    "export_id": export_id,
+                    "created_before": upper,
+                    "created_after": lower,
+                }
+                for lower, upper in itertools.pairwise(bounds)
+            ],
+        )
         self._conn.commit()
+        shards = self.get(export_id=export_id)
+        self._log.info("created export shards", export_id=export_id, count=len(shards))
+        return shards
+
+    def checkpoint(self, *, shard_id: int, cursor: int, is_complete: bool) -> None:
+        """
+        Doesn't commit, see `ExportTable.checkpoint`.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+update tiktok_export_shards
+set
+    cursor = :cursor,
+    completed_at = case when :is_complete then current_timestamp end
+where id = :shard_id
+        """,
+            {"shard_id": shard_id, "cursor": cursor, "is_complete": is_complete},
+        )
+
+
+def post_body_hash(post_json: str) -> bytes:
+    return hashlib.sha256(post_json.encode()).digest()
 
 
 @dataclass(frozen=True, slots=True)
-class PostCreateParams:
+class RequestCreateParams:
+    export_id: int
     http_request_duration_sec: float
+    http_request_connect_sec: float | None
+    http_request_tls_sec: float | None
     http_request_param_cursor: int
     http_request_url: str
     http_response_headers_json: dict[str, str]
-    export_id: int
-    post_json: dict[str, Any]
 
     def to_dict(self) -> dict[str, Any]:
         return {
+            "export_id": self.export_id,
             "http_request_duration_sec": self.http_request_duration_sec,
+            "http_request_connect_sec": self.http_request_connect_sec,
+            "http_request_tls_sec": self.http_request_tls_sec,
             "http_request_param_cursor": self.http_request_param_cursor,
             "http_request_url": self.http_request_url,
             "http_response_headers_json": json.dumps(self.http_response_headers_json),
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class RequestTable:
+    _conn: sqlite3.Connection
+
+    def create(self, params: RequestCreateParams) -> int:
+        """
+        Doesn't commit, see `DB.batched_commits`.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+insert into tiktok_requests(
+    export_id,
+    http_request_duration_sec,
+    http_request_connect_sec,
+    http_request_tls_sec,
+    http_request_param_cursor,
+    http_request_url,
+    http_response_headers_json
+) values (
+    :export_id,
+    :http_request_duration_sec,
+    :http_request_connect_sec,
+    :http_request_tls_sec,
+    :http_request_param_cursor,
+    :http_request_url,
+    :http_response_headers_json
+)
+        """,
+            params.to_dict(),
+        )
+        assert cur.lastrowid is not None
+        return cur.lastrowid
+
+
+@dataclass(frozen=True, slots=True)
+class PostCreateParams:
+    export_id: int
+    request_id: int
+    # the post's json text, as sent by the api
+    post_json: str
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
             "export_id": self.export_id,
-            "post_json": json.dumps(self.post_json),
+            "request_id": self.request_id,
+            "body_hash": post_body_hash(self.post_json),
+            "post_json": self.post_json,
         }
 
 
@@ -160,138 +419,976 @@ class Slideshow:
     images: list[str]
 
 
+@dataclass(frozen=True, slots=True)
+class PostVideo:
+    id: str
+    author: str
+    desc: str
+    is_video: bool
+    # the video for videos, the audio track for slideshows
+    url: str
+
+
+PostChangeKind = Literal["added", "removed", "changed"]
+
+
+@dataclass(frozen=True, slots=True)
+class PostChange:
+    change: PostChangeKind
+    id: str
+    author: str | None
+    desc: str | None
+    created_at: int | None
+
+
+def _stable_post_fields(post_body: str) -> str:
+    """
+    SQL for the parts of a `tiktok_post_bodies` row's json that only change
+    when the post is edited: the description, author, video and number of
+    slideshow images.
+    """
+    # `decompress_json` remembers the last payload, so the second call is free
+    post_json = f"decompress_json({post_body}.post_json)"
+    return f"""json_array(
+        json_extract({post_json}, '$.desc', '$.author.uniqueId', '$.video.id'),
+        json_array_length({post_json}, '$.imagePost.images')
+    )"""
+
+
 @dataclass(frozen=True, slots=True)
 class PostTable:
     _conn: sqlite3.Connection
+    _compressor: PostJsonCompressor
 
     def create(self, records: Sequence[PostCreateParams]) -> int:
+        """
+        Post bodies are stored once per distinct `post_json`, so a post that
+        hasn't changed since a previous export only costs a membership row.
+
+        Doesn't commit, see `DB.batched_commits`.
+        """
+        with metrics.time("serialize_posts"):
+            params = [r.to_dict() for r in records]
+        with metrics.time("db_insert"):
+            posts_created_count = self._insert(params)
+        metrics.incr("posts_inserted", posts_created_count)
+        return posts_created_count
+
+    def _insert(self, params: list[dict[str, Any]]) -> int:
         cur = self._conn.cursor()
+        hashes = [p["body_hash"] for p in params]
+        existing_hashes = {
+            hash
+            for (hash,) in cur.execute(
+                f"""
+select hash
+from tiktok_post_bodies
+where hash in ({", ".join("?" * len(hashes))});
+            """,
+                hashes,
+            )
+        }
         cur.executemany(
             """
-insert or ignore into tiktok_posts(
-    http_request_duration_sec, 
-    http_request_param_cursor, 
-    http_request_url,
-    http_response_headers_json, 
-    export_id,
+insert or ignore into tiktok_post_bodies(
+    hash,
+    post_id,
+    post_author,
+    post_is_video,
+    post_created_at,
     post_json
 ) values (
-    :http_request_duration_sec, 
-    :http_request_param_cursor, 
-    :http_request_url,
-    :http_response_headers_json, 
-    :export_id, 
-    :post_json
+    :body_hash,
+    json_extract(:post_json, '$.id'),
+    json_extract(:post_json, '$.author.uniqueId'),
+    json_extract(:post_json, '$.imagePost') IS NULL,
+    json_extract(:post_json, '$.createTime'),
+    :stored_post_json
 )
         """,
-            [r.to_dict() for r in records],
+            [
+                {
+                    **p,
+                    "stored_post_json": self._compressor.compress(p["post_json"]),
+                }
+                for p in params
+                if p["body_hash"] not in existing_hashes
+            ],
+        )
+        cur.executemany(
+            """
+insert or ignore into tiktok_posts(
+    export_id,
+    request_id,
+    post_id,
+    post_is_video,
+    body_hash
+)
+select
+    :export_id,
+    :request_id,
+    post_id,
+    post_is_video,
+    hash
+from tiktok_post_bodies
+where hash = :body_hash
+        """,
+            params,
         )
-        self._conn.commit()
         return cur.rowcount
 
-    def urls(self, export_id: int, *, starting_after: int | None = None) -> list[str]:
+    def known_ids(self, export_id: int) -> set[str]:
+        """
+        Ids of every post saved by the export.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select post_id from tiktok_posts where export_id = :export_id;
+        """,
+            {"export_id": export_id},
+        )
+        return {post_id for (post_id,) in _iter_rows(cur)}
+
+    def urls(
+        self, export_id: int, *, starting_after: int | None = None
+    ) -> Iterator[str]:
         cur = self._conn.cursor()
         cur.execute(
             """
 SELECT
-	post_id,
-	post_author
+	tiktok_posts.post_id,
+	tiktok_post_bodies.post_author
 FROM
-	tiktok_posts
+	tiktok_requests
+	JOIN tiktok_posts ON tiktok_posts.request_id = tiktok_requests.id
+	JOIN tiktok_post_bodies ON tiktok_post_bodies.hash = tiktok_posts.body_hash
 WHERE
-	export_id = :export_id
-	AND (:starting_after is null or http_request_param_cursor > :starting_after)
-GROUP BY
-	post_id;
+	tiktok_requests.export_id = :export_id
+	-- cursors are unix timestamps, written as a range so it can use the index
+	AND tiktok_requests.http_request_param_cursor > coalesce(:starting_after, -1);
         """,
             {"export_id": export_id, "starting_after": starting_after},
         )
-        urls = list[str]()
-        for post_id, author in cur.fetchall():
-            url = f"https://tiktok.com/@{author}/video/{post_id}"
-            urls.append(url)
-        return urls
+        for post_id, author in _iter_rows(cur):
+            yield f"https://tiktok.com/@{author}/video/{post_id}"
 
-    def slideshows(self, export_id: int) -> list[Slideshow]:
+    def slideshows(
+        self, export_id: int, *, starting_after: int | None = None
+    ) -> Iterator[Slideshow]:
+        """
+        `starting_after` limits it to pages fetched with a later cursor, like
+        `urls`.
+        """
         cur = self._conn.cursor()
         cur.execute(
             """
 select
-	post_id,
-    post_author,
-    json_extract(post_json, '$.desc'),
-    json_extract(post_json, '$.imagePost.images')
+    tiktok_posts.post_id,
+    tiktok_post_bodies.post_author,
+    json_extract(decompress_json(tiktok_post_bodies.post_json), '$.desc'),
+    json_extract(decompress_json(tiktok_post_bodies.post_json), '$.imagePost.images')
 from tiktok_posts
+join tiktok_post_bodies on tiktok_post_bodies.hash = tiktok_posts.body_hash
 where 
-    export_id = :export_id
-    and not post_is_video;
+    tiktok_posts.export_id = :export_id
+    and tiktok_posts.post_is_video = 0
+    and (
+        :starting_after is null
+        or tiktok_posts.request_id in (
+            select id from tiktok_requests
+            where
+                export_id = :export_id
+                and http_request_param_cursor > :starting_after
+        )
+    );
         """,
-            {"export_id": export_id},
+            {"export_id": export_id, "starting_after": starting_after},
         )
-        urls = list[Slideshow]()
-        for post_id, author, desc, img_data in cur.fetchall():
+        for post_id, author, desc, img_data in _iter_rows(cur):
             images = list[str]()
             for image in json.loads(img_data):
                 images.append(image["imageURL"]["urlList"][0])
-            urls.append(Slideshow(id=post_id, author=author, desc=desc, images=images))
-        return urls
+            yield Slideshow(id=post_id, author=author, desc=desc, images=images)
+
+    def videos(self, export_id: int) -> Iterator[PostVideo]:
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select
+    tiktok_posts.post_id,
+    tiktok_post_bodies.post_author,
+    json_extract(decompress_json(tiktok_post_bodies.post_json), '$.desc'),
+    tiktok_posts.post_is_video,
+    case
+        when tiktok_posts.post_is_video then coalesce(
+            nullif(json_extract(decompress_json(tiktok_post_bodies.post_json), '$.video.playAddr'), ''),
+            nullif(json_extract(decompress_json(tiktok_post_bodies.post_json), '$.video.downloadAddr'), '')
+        )
+        else nullif(json_extract(decompress_json(tiktok_post_bodies.post_json), '$.music.playUrl'), '')
+    end as url
+from tiktok_posts
+join tiktok_post_bodies on tiktok_post_bodies.hash = tiktok_posts.body_hash
+where
+    tiktok_posts.export_id = :export_id
+    and url is not null;
+        """,
+            {"export_id": export_id},
+        )
+        for post_id, author, desc, is_video, url in _iter_rows(cur):
+            yield PostVideo(
+                id=post_id, author=author, desc=desc, is_video=bool(is_video), url=url
+            )
+
+    def diff(
+        self, *, export_id: int, prior_export_ids: Sequence[int]
+    ) -> Iterator[PostChange]:
+        """
+        Posts added to `export_id`, removed from it or changed, compared to
+        the union of `prior_export_ids`. A post is compared with its version
+        in the newest prior export that has it.
+
+        Only a change to what the author controls counts, see
+        `_stable_post_fields`. The stats and signed media urls change between
+        almost every fetch.
+
+        Every lookup is an anti-join on `unique_videos_per_export`, nothing
+        is loaded into memory.
+        """
+        params = {
+            "export_id": export_id,
+            "prior_export_ids": json.dumps(list(prior_export_ids)),
+        }
+
+        def newest_prior_export_id(post_id: str) -> str:
+            # with one prior export it's that one, skip the lookup per post
+            if len(prior_export_ids) == 1:
+                return str(int(prior_export_ids[0]))
+            return f"""(
+        select max(prior.export_id) from tiktok_posts prior
+        where
+            prior.export_id in (select value from json_each(:prior_export_ids))
+            and prior.post_id = {post_id}
+    )"""
+
+        queries: list[tuple[PostChangeKind, str]] = [
+            (
+                "added",
+                """
+select new.post_id, new.body_hash
+from tiktok_posts new
+where
+    new.export_id = :export_id
+    and not exists (
+        select 1 from tiktok_posts old
+        where
+            old.export_id in (select value from json_each(:prior_export_ids))
+            and old.post_id = new.post_id
+    )
+                """,
+            ),
+            (
+                "removed",
+                f"""
+select old.post_id, old.body_hash
+from tiktok_posts old
+where
+    old.export_id in (select value from json_each(:prior_export_ids))
+    and not exists (
+        select 1 from tiktok_posts new
+        where new.export_id = :export_id and new.post_id = old.post_id
+    )
+    -- once per post, its newest version
+    and old.export_id = {newest_prior_export_id("old.post_id")}
+                """,
+            ),
+            (
+                "changed",
+                f"""
+select new.post_id, new.body_hash
+from tiktok_posts new
+join tiktok_posts old on
+    old.export_id = {newest_prior_export_id("new.post_id")}
+    and old.post_id = new.post_id
+join tiktok_post_bodies new_body on new_body.hash = new.body_hash
+join tiktok_post_bodies old_body on old_body.hash = old.body_hash
+where
+    new.export_id = :export_id
+    and old.body_hash != new.body_hash
+    and {_stable_post_fields("old_body")} != {_stable_post_fields("new_body")}
+                """,
+            ),
+        ]
+        cur = self._conn.cursor()
+        for change, query in queries:
+            cur.execute(
+                f"""
+select
+    changes.post_id,
+    tiktok_post_bodies.post_author,
+    json_extract(decompress_json(tiktok_post_bodies.post_json), '$.desc'),
+    tiktok_post_bodies.post_created_at
+from ({query}) changes
+join tiktok_post_bodies on tiktok_post_bodies.hash = changes.body_hash;
+            """,
+                params,
+            )
+            for post_id, author, desc, created_at in _iter_rows(cur):
+                yield PostChange(
+                    change=change,
+                    id=post_id,
+                    author=author,
+                    desc=desc,
+                    created_at=created_at,
+                )
+
+    def sample_json(self, *, limit: int) -> list[bytes]:
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select decompress_json(post_json)
+from tiktok_post_bodies
+where id in (select id from tiktok_post_bodies order by random() limit :limit);
+        """,
+            {"limit": limit},
+        )
+        return [post_json.encode() for (post_json,) in cur.fetchall()]
+
+    def recompress(self, *, batch_size: int = 1000) -> int:
+        """
+        Rewrite every post body's `post_json` with the current codec, committing
+        after each batch.
+        """
+        cur = self._conn.cursor()
+        last_id = -1
+        rewritten_count = 0
+        while True:
+            rows = cur.execute(
+                """
+select id, post_json
+from tiktok_post_bodies
+where id > :last_id
+order by id
+limit :batch_size;
+            """,
+                {"last_id": last_id, "batch_size": batch_size},
+            ).fetchall()
+            if not rows:
+                return rewritten_count
+            cur.executemany(
+                "update tiktok_post_bodies set post_json = :post_json where id = :id",
+                [
+                    {
+                        "id": id,
+                        "post_json": self._compressor.compress(
+                            self._compressor.decompress(post_json)
+                        ),
+                    }
+                    for id, post_json in rows
+                ],
+            )
+            self._conn.commit()
+            rewritten_count += len(rows)
+            last_id = rows[-1][0]
+
+
+MediaStatus = Literal["complete", "failed", "expired"]
+
+
+@dataclass(frozen=True, slots=True)
+class MediaSaveParams:
+    post_id: str
+    slide_index: int
+    url: str
+    status: MediaStatus
+    path: str | None = None
+    size_bytes: int | None = None
+    sha256: str | None = None
+    error: str | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "post_id": self.post_id,
+            "slide_index": self.slide_index,
+            "url": self.url,
+            "status": self.status,
+            "path": self.path,
+            "size_bytes": self.size_bytes,
+            "sha256": self.sha256,
+            "error": self.error,
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class SavedMedia:
+    path: str
+    sha256: str
+
+
+@dataclass(frozen=True, slots=True)
+class MediaTable:
+    _conn: sqlite3.Connection
+
+    def completed(self) -> dict[tuple[str, int], SavedMedia]:
+        """
+        Every saved slide, keyed by (post_id, slide_index).
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select post_id, slide_index, path, sha256
+from tiktok_media
+where status = 'complete';
+        """
+        )
+        return {
+            (post_id, slide_index): SavedMedia(path=path, sha256=sha256)
+            for post_id, slide_index, path, sha256 in _iter_rows(cur)
+        }
+
+    def save(self, params: MediaSaveParams) -> None:
+        """
+        Doesn't commit, see `DB.batched_commits`.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+insert into tiktok_media(
+    post_id,
+    slide_index,
+    url,
+    status,
+    path,
+    size_bytes,
+    sha256,
+    error
+) values (
+    :post_id,
+    :slide_index,
+    :url,
+    :status,
+    :path,
+    :size_bytes,
+    :sha256,
+    :error
+)
+on conflict (post_id, slide_index) do update set
+    url = excluded.url,
+    status = excluded.status,
+    path = excluded.path,
+    size_bytes = excluded.size_bytes,
+    sha256 = excluded.sha256,
+    error = excluded.error,
+    updated_at = current_timestamp;
+        """,
+            params.to_dict(),
+        )
+
+
+JobStatus = Literal["pending", "leased", "complete", "failed", "expired"]
+
+
+@dataclass(frozen=True, slots=True)
+class JobCreateParams:
+    post_id: str
+    slide_index: int
+    url: str
+    filename_stem: str
+    expires_at: int | None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "post_id": self.post_id,
+            "slide_index": self.slide_index,
+            "url": self.url,
+            "filename_stem": self.filename_stem,
+            "expires_at": self.expires_at,
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class Job:
+    id: int
+    post_id: str
+    slide_index: int
+    url: str
+    filename_stem: str
+    attempts: int
+
+
+@dataclass(frozen=True, slots=True)
+class JobTable:
+    """
+    A queue of slides to download that any number of processes can work
+    through, see `tiktoker worker`.
+
+    Leases are unix timestamps, workers on different hosts need their clocks
+    roughly in sync.
+    """
+
+    _conn: sqlite3.Connection
+
+    def enqueue(self, jobs: Sequence[JobCreateParams]) -> None:
+        """
+        Add jobs for slides that don't have one. A failed or expired slide is
+        queued again with its new url, a complete one is left alone.
+        """
+        cur = self._conn.cursor()
+        cur.executemany(
+            """
+insert into tiktok_jobs(post_id, slide_index, url, filename_stem, expires_at)
+values (:post_id, :slide_index, :url, :filename_stem, :expires_at)
+on conflict (post_id, slide_index) do update set
+    url = excluded.url,
+    filename_stem = excluded.filename_stem,
+    expires_at = excluded.expires_at,
+    status = 'pending',
+    attempts = 0,
+    error = null,
+    updated_at = current_timestamp
+where tiktok_jobs.status in ('failed', 'expired');
+        """,
+            [job.to_dict() for job in jobs],
+        )
+        self._conn.commit()
+
+    def claim(self, *, owner: str, limit: int, lease_sec: float) -> list[Job]:
+        """
+        Lease up to `limit` jobs to `owner`, soonest expiring first, taking
+        back jobs whose lease ran out along the way.
+
+        Both updates run in one write transaction so two workers can never
+        claim the same job.
+        """
+        now = time.time()
+        cur = self._conn.cursor()
+        try:
+            cur.execute(
+                """
+update tiktok_jobs
+set
+    status = 'pending',
+    lease_owner = null,
+    lease_expires_at = null,
+    updated_at = current_timestamp
+where status = 'leased' and lease_expires_at < :now;
+            """,
+                {"now": now},
+            )
+            reclaimed_count = cur.rowcount
+            cur.execute(
+                """
+update tiktok_jobs
+set
+    status = 'leased',
+    lease_owner = :owner,
+    lease_expires_at = :lease_expires_at,
+    attempts = attempts + 1,
+    updated_at = current_timestamp
+where id in (
+    select id from tiktok_jobs
+    where status = 'pending'
+    order by ifnull(expires_at, 9223372036854775807), id
+    limit :limit
+)
+returning id, post_id, slide_index, url, filename_stem, attempts;
+            """,
+                {"owner": owner, "lease_expires_at": now + lease_sec, "limit": limit},
+            )
+            rows = cur.fetchall()
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+        if reclaimed_count:
+            metrics.incr("jobs_reclaimed", reclaimed_count)
+        return sorted(
+            (
+                Job(
+                    id=job_id,
+                    post_id=post_id,
+                    slide_index=slide_index,
+                    url=url,
+                    filename_stem=filename_stem,
+                    attempts=attempts,
+                )
+                for job_id, post_id, slide_index, url, filename_stem, attempts in rows
+            ),
+            # `returning` doesn't keep the subquery's order
+            key=lambda job: job.id,
+        )
+
+    def heartbeat(self, *, owner: str, lease_sec: float) -> int:
+        """
+        Extend every lease `owner` holds, returns how many it still has.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+update tiktok_jobs
+set lease_expires_at = :lease_expires_at
+where lease_owner = :owner and status = 'leased';
+        """,
+            {"owner": owner, "lease_expires_at": time.time() + lease_sec},
+        )
+        self._conn.commit()
+        return cur.rowcount
+
+    def finish(
+        self, *, job_id: int, owner: str, status: JobStatus, error: str | None = None
+    ) -> bool:
+        """
+        Release a job with its outcome, `pending` to try it again later.
+        Returns False if `owner` lost the lease in the meantime.
+
+        Doesn't commit, see `DB.batched_commits`.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+update tiktok_jobs
+set
+    status = :status,
+    error = :error,
+    lease_owner = null,
+    lease_expires_at = null,
+    updated_at = current_timestamp
+where id = :job_id and lease_owner = :owner and status = 'leased';
+        """,
+            {"job_id": job_id, "owner": owner, "status": status, "error": error},
+        )
+        return cur.rowcount == 1
+
+    def counts(self) -> dict[JobStatus, int]:
+        cur = self._conn.cursor()
+        cur.execute("select status, count(*) from tiktok_jobs group by status;")
+        return dict(cur.fetchall())
+
+
+def _match_query(text: str) -> str:
+    """
+    Quote each word so user input can't be fts5 query syntax, `#` and `@`
+    would otherwise be syntax errors. A trailing `*` still matches prefixes.
+    """
+    terms = list[str]()
+    for word in text.split():
+        is_prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            quoted = '"' + word.replace('"', '""') + '"'
+            terms.append(quoted + "*" if is_prefix else quoted)
+    return " ".join(terms)
+
+
+@dataclass(frozen=True, slots=True)
+class SearchResult:
+    post_id: str
+    author: str | None
+    created_at: int | None
+    snippet: str
+    # pass both to `SearchTable.search` as `after` for the next page
+    rank: float
+    body_id: int
+
+
+@dataclass(frozen=True, slots=True)
+class SearchTable:
+    _conn: sqlite3.Connection
+    _log: BoundLogger
+
+    def search(
+        self,
+        text: str,
+        *,
+        limit: int,
+        after: tuple[float, int] | None = None,
+        export_id: int | None = None,
+    ) -> list[SearchResult]:
+        """
+        Posts matching every word of `text`, best match first. Pages are
+        keyed by the last result's (rank, body_id) instead of an offset so
+        later pages are as fast as the first.
+        """
+        query = _match_query(text)
+        if not query:
+            return []
+        after_rank, after_body_id = after if after is not None else (None, None)
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+select
+    tiktok_post_bodies.post_id,
+    tiktok_post_bodies.post_author,
+    tiktok_post_bodies.post_created_at,
+    snippet(tiktok_post_search, 0, '[', ']', '...', 16),
+    tiktok_post_search.rank,
+    tiktok_post_search.rowid
+from tiktok_post_search
+join tiktok_post_bodies on tiktok_post_bodies.id = tiktok_post_search.rowid
+where
+    tiktok_post_search match :query
+    and (
+        :after_rank is null
+        or (tiktok_post_search.rank, tiktok_post_search.rowid) > (:after_rank, :after_body_id)
+    )
+    and (
+        :export_id is null
+        or exists (
+            select 1 from tiktok_posts
+            where
+                tiktok_posts.export_id = :export_id
+                and tiktok_posts.post_id = tiktok_post_bodies.post_id
+        )
+    )
+order by tiktok_post_search.rank, tiktok_post_search.rowid
+limit :limit;
+        """,
+            {
+                "query": query,
+                "after_rank": after_rank,
+                "after_body_id": after_body_id,
+                "export_id": export_id,
+                "limit": limit,
+            },
+        )
+        return [
+            SearchResult(
+                post_id=post_id,
+                author=author,
+                created_at=created_at,
+                snippet=snippet,
+                rank=rank,
+                body_id=body_id,
+            )
+            for post_id, author, created_at, snippet, rank, body_id in cur.fetchall()
+        ]
+
+    def rebuild(self) -> int:
+        """
+        Reindex the newest version of every post, for when the index is
+        missing posts, e.g. ones inserted by something other than tiktoker.
+        """
+        cur = self._conn.cursor()
+        cur.execute("delete from tiktok_post_search;")
+        cur.execute(
+            """
+insert into tiktok_post_search(rowid, description, author, hashtags)
+select
+    id,
+    json_extract(post_json, '$.desc'),
+    coalesce(json_extract(post_json, '$.author.uniqueId'), '')
+        || ' ' || coalesce(json_extract(post_json, '$.author.nickname'), ''),
+    (
+        select group_concat(json_extract(value, '$.title'), ' ')
+        from json_each(post_json, '$.challenges')
+    )
+from (
+    select id, decompress_json(post_json) as post_json
+    from tiktok_post_bodies
+    where id in (select max(id) from tiktok_post_bodies group by post_id)
+);
+        """
+        )
+        indexed_count = cur.rowcount
+        cur.execute(
+            "insert into tiktok_post_search(tiktok_post_search) values ('optimize');"
+        )
+        self._conn.commit()
+        self._log.info("rebuilt search index", posts_count=indexed_count)
+        return indexed_count
+
+
+@dataclass(frozen=True, slots=True)
+class CompressionDictTable:
+    _conn: sqlite3.Connection
+    _compressor: PostJsonCompressor
+
+    def load(self) -> None:
+        cur = self._conn.cursor()
+        (table_exists,) = cur.execute(
+            """
+select count(*)
+from sqlite_schema
+where type = 'table' and name = 'tiktok_compression_dicts';
+        """
+        ).fetchone()
+        if not table_exists:
+            return
+        rows = cur.execute(
+            """
+select id, codec, dict
+from tiktok_compression_dicts
+order by id;
+        """
+        ).fetchall()
+        for idx, (id, codec, data) in enumerate(rows, start=1):
+            self._compressor.add(
+                Dictionary(id=id, codec=codec, data=data), current=idx == len(rows)
+            )
+
+    def create(self, *, codec: Codec, data: bytes | None) -> Dictionary:
+        """
+        Save a new dictionary and use it to compress posts from now on.
+        """
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+insert into tiktok_compression_dicts(codec, dict) values (:codec, :dict);
+        """,
+            {"codec": codec, "dict": data},
+        )
+        self._conn.commit()
+        assert cur.lastrowid is not None
+        dictionary = Dictionary(id=cur.lastrowid, codec=codec, data=data)
+        self._compressor.add(dictionary, current=True)
+        return dictionary
 
 
 @dataclass(frozen=True, slots=True)
 class DB:
     _conn: sqlite3.Connection
     _log: BoundLogger
+    _compressor: PostJsonCompressor
 
     @classmethod
-    def create(cls, *, path: str, log: BoundLogger) -> "DB":
+    def create(cls, *, path: str, log: BoundLogger, write_mode: bool = False) -> "DB":
+        """
+        `write_mode` tunes the connection for bulk inserts. It switches the
+        database to WAL, which persists in the file, so readers like the
+        slideshow exporter can run while an export is writing.
+        """
         conn = sqlite3.connect(path)
         conn.execute("PRAGMA foreign_keys = ON")
-        db = DB(conn, log)
-        db._create_tables()
+        conn.execute("PRAGMA busy_timeout = 10000")
+        if write_mode:
+            conn.execute("PRAGMA journal_mode = WAL")
+            # with WAL, NORMAL only fsyncs on checkpoints. A power loss can
+            # drop the last few transactions but never corrupts the db.
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA cache_size = -65536")  # 64 MiB
+            conn.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+        compressor = PostJsonCompressor()
+        conn.create_function(
+            "decompress_json", 1, compressor.decompress, deterministic=True
+        )
+        db = DB(conn, log, compressor)
+        compressor.reload = db.compression_dicts.load
+        # migrations may need to decompress existing posts
+        db.compression_dicts.load()
+        migrate(conn, log)
         return db
 
-    def _create_tables(self) -> None:
-        cur = self._conn.cursor()
-        cur.executescript(
-            """
-create table if not exists tiktok_export (
-    id integer primary key,
-    completed_at text, -- TODO: only one of the rows should be able to have: completed_at is null
-    cursor integer not null,
-    created_at text default current_timestamp not null
-) strict;
+    def size_bytes(self) -> int:
+        (page_count,) = self._conn.execute("pragma page_count").fetchone()
+        (page_size,) = self._conn.execute("pragma page_size").fetchone()
+        return page_count * page_size
 
-create table if not exists tiktok_posts (
-    id integer primary key,
+    def vacuum(self) -> None:
+        self._conn.execute("vacuum")
+        # with WAL the rewritten pages are in the -wal file until a checkpoint
+        self._conn.execute("pragma wal_checkpoint(truncate)")
 
-    export_id integer not null,
+    @contextmanager
+    def batched_commits(
+        self, *, every: int
+    ) -> Generator[Callable[[], None], None, None]:
+        """
+        Yields a function to call after each page of writes. Pages are
+        committed together once `every` of them are pending, and any
+        remaining pages are committed when the block exits.
 
-    http_request_url text not null,
-    http_request_duration_sec real not null,
-    http_request_param_cursor integer not null,
-    http_response_headers_json text not null check (json_valid(http_response_headers_json)),
-    
-    post_id text generated always AS (json_extract(post_json, '$.id')) virtual,
-    post_author text generated always AS (json_extract(post_json, '$.author.uniqueId')) virtual,
-    post_is_video integer generated always AS (json_extract(post_json, '$.imagePost') IS NULL) virtual,
-    post_created_at integer generated always AS (json_extract(post_json, '$.createTime')) virtual,
-    post_json text not null check (json_valid(post_json)),
+        A page's posts and its export checkpoint must be written before
+        calling the function so they always land in the same transaction.
+        If the block raises, uncommitted pages are rolled back.
+        """
+        pending = 0
 
-    created_at text default current_timestamp not null,
+        def page_done() -> None:
+            nonlocal pending
+            pending += 1
+            if pending >= every:
+                with metrics.time("db_commit"):
+                    self._conn.commit()
+                pending = 0
 
-    foreign key(export_id) references tiktok_export(id)
-) strict;
+        try:
+            yield page_done
+        except BaseException:
+            self._conn.rollback()
+            raise
+        with metrics.time("db_commit"):
+            self._conn.commit()
 
-create unique index if not exists
-    unique_videos_per_export on tiktok_posts (export_id, post_id);
+    @contextmanager
+    def deferred_writes(
+        self, *, every: int, interval_sec: float
+    ) -> Generator[Callable[[Callable[[], None]], None], None, None]:
         """
-        )
-        self._conn.commit()
+        Yields a function that queues a write to run later. Queued writes run
+        in one transaction once `every` of them are pending or `interval_sec`
+        has passed since the last flush, and any left over when the block
+        exits.
+
+        Unlike `batched_commits` the write lock is only held while flushing,
+        so a command that waits on the network between writes doesn't lock
+        out an export running alongside it.
+        """
+        queued = list[Callable[[], None]]()
+        last_flush = time.monotonic()
+
+        def flush() -> None:
+            nonlocal last_flush
+            last_flush = time.monotonic()
+            writes = queued.copy()
+            queued.clear()
+            try:
+                for write in writes:
+                    write()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            with metrics.time("db_commit"):
+                self._conn.commit()
+
+        def defer(write: Callable[[], None]) -> None:
+            queued.append(write)
+            if len(queued) >= every or time.monotonic() - last_flush >= interval_sec:
+                flush()
+
+        try:
+            yield defer
+        finally:
+            # the writes record work that's already done, keep it either way
+            flush()
 
     @property
     def export(self) -> ExportTable:
         return ExportTable(self._conn, self._log)
 
+    @property
+    def export_shards(self) -> ExportShardTable:
+        return ExportShardTable(self._conn, self._log)
+
+    @property
+    def requests(self) -> RequestTable:
+        return RequestTable(self._conn)
+
     @property
     def posts(self) -> PostTable:
-        return PostTable(self._conn)
+        return PostTable(self._conn, self._compressor)
+
+    @property
+    def media(self) -> MediaTable:
+        return MediaTable(self._conn)
+
+    @property
+    def jobs(self) -> JobTable:
+        return JobTable(self._conn)
+
+    @property
+    def search(self) -> SearchTable:
+        return SearchTable(self._conn, self._log)
+
+    @property
+    def compression_dicts(self) -> CompressionDictTable:
+        return CompressionDictTable(self._conn, self._compressor)
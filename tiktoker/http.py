@@ -1,21 +1,113 @@
+import asyncio
 import mimetypes
+import time
+from collections import defaultdict
+from collections.abc import AsyncGenerator, Awaitable, Callable, Iterable, Mapping
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Protocol, TypeVar
+from urllib.parse import parse_qs, urlparse
 
 import httpx
 from structlog.stdlib import get_logger
-from tenacity import retry, retry_if_exception_type, wait_exponential, wait_random
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+    wait_random,
+)
+
+from tiktoker.blobs import BlobStore
+from tiktoker.metrics import metrics
+from tiktoker.ratelimit import RateLimiters
 
 logger = get_logger()
 
+# After this many tries a download is given up on and its last error is
+# raised, so callers can record it and move on to the next one.
+_MEDIA_ATTEMPTS = 5
+
 
 @dataclass(frozen=True, slots=True)
-class ImageResult:
-    content: bytes
+class BlobResult:
+    sha256: str
+    size_bytes: int
     extension: str | None
 
 
+class DownloadJob(Protocol):
+    @property
+    def url(self) -> str:
+        ...
+
+
+JobT = TypeVar("JobT", bound=DownloadJob)
+ResultT = TypeVar("ResultT")
+
+
+def url_expires_at(url: str) -> datetime | None:
+    """
+    TikTok's CDN urls are signed and stop working after the unix timestamp in
+    `x-expires` (images) or `expire` (videos).
+    """
+    query_params = parse_qs(urlparse(url).query)
+    for param in ("x-expires", "expire"):
+        if param in query_params:
+            return datetime.fromtimestamp(int(query_params[param][0]), tz=UTC)
+    return None
+
+
+def is_expired_url(url: str) -> bool:
+    expires_at = url_expires_at(url)
+    return expires_at is not None and expires_at < datetime.now(tz=UTC)
+
+
+@asynccontextmanager
+async def _paced_stream(
+    client: httpx.AsyncClient,
+    url: str,
+    *,
+    limiters: RateLimiters,
+    headers: Mapping[str, str] | None = None,
+) -> AsyncGenerator[httpx.Response, None]:
+    """
+    `client.stream("GET", ...)` that waits its turn with the host's rate
+    limiter and reports back how the request went.
+    """
+    limiter = limiters.for_url(url)
+    await limiter.wait_async()
+    start = time.monotonic()
+    try:
+        res = await client.send(
+            client.build_request("GET", url, headers=headers), stream=True
+        )
+    except httpx.TransportError:
+        limiter.observe(status_code=None, latency_sec=time.monotonic() - start)
+        raise
+    latency_sec = time.monotonic() - start
+    metrics.observe("media_http_wait", latency_sec)
+    limiter.observe_response(res, latency_sec=latency_sec)
+    try:
+        yield res
+    finally:
+        await res.aclose()
+
+
+def _is_retryable_media_error(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        # a 403 or 404 means the media is gone or the url is no longer valid,
+        # retrying won't help.
+        return e.response.status_code == 429 or e.response.is_server_error
+    return isinstance(e, httpx.HTTPError)
+
+
 @retry(
-    retry=retry_if_exception_type(httpx.HTTPError),
+    retry=retry_if_exception(_is_retryable_media_error),
+    stop=stop_after_attempt(_MEDIA_ATTEMPTS),
+    reraise=True,
     wait=wait_exponential(multiplier=1, min=0.5, max=15) + wait_random(0, 2),
     after=lambda x: logger.warning(
         "download image request failed. Retrying...",
@@ -23,10 +115,100 @@ class ImageResult:
         exec=x.outcome is not None and x.outcome.exception(),  # pyright: ignore [reportUnknownMemberType]
     ),
 )
-def download_image(*, url: str) -> ImageResult:
-    res = httpx.get(url)
-    res.raise_for_status()
-    content_type = res.headers["content-type"]
-    extension = mimetypes.guess_extension(content_type)
+async def download_blob(
+    client: httpx.AsyncClient, *, url: str, store: BlobStore, limiters: RateLimiters
+) -> BlobResult:
+    """
+    Stream `url` into `store` without holding the whole response in memory.
+    """
+    async with _paced_stream(client, url, limiters=limiters) as res:
+        res.raise_for_status()
+        with store.writer() as writer:
+            async for chunk in res.aiter_bytes():
+                writer.write(chunk)
+        content_type = res.headers.get("content-type")
+    return BlobResult(
+        sha256=writer.sha256,
+        size_bytes=writer.size_bytes,
+        extension=mimetypes.guess_extension(content_type) if content_type else None,
+    )
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable_media_error),
+    stop=stop_after_attempt(_MEDIA_ATTEMPTS),
+    reraise=True,
+    wait=wait_exponential(multiplier=1, min=0.5, max=15) + wait_random(0, 2),
+    after=lambda x: logger.warning(
+        "download file request failed. Retrying...",
+        attempt=x.attempt_number,
+        exec=x.outcome is not None and x.outcome.exception(),  # pyright: ignore [reportUnknownMemberType]
+    ),
+)
+async def download_file(
+    client: httpx.AsyncClient, *, url: str, path: Path, limiters: RateLimiters
+) -> str | None:
+    """
+    Stream `url` into `path`. If `path` already has content, only the rest of
+    the file is requested, so an interrupted download (or a failed attempt)
+    picks up where it left off.
+
+    Returns the file extension from the response's content type, if any.
+    """
+    offset = path.stat().st_size if path.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    async with _paced_stream(client, url, limiters=limiters, headers=headers) as res:
+        if res.status_code == 416:  # Range Not Satisfiable
+            # we already have every byte
+            return None
+        res.raise_for_status()
+        # servers that ignore the Range header send the whole file again
+        mode = "ab" if res.status_code == 206 else "wb"  # 206 Partial Content
+        with path.open(mode) as f:
+            async for chunk in res.aiter_bytes():
+                f.write(chunk)
+        content_type = res.headers.get("content-type")
+        return mimetypes.guess_extension(content_type) if content_type else None
+
+
+async def download_all(
+    jobs: Iterable[JobT],
+    *,
+    download: Callable[[httpx.AsyncClient, JobT], Awaitable[ResultT]],
+    on_result: Callable[[JobT, ResultT], None],
+    concurrency: int,
+    per_host_concurrency: int,
+    headers: Mapping[str, str] | None = None,
+) -> None:
+    """
+    Run `download` for every job using `concurrency` workers, with at most
+    `per_host_concurrency` requests in flight to any single host.
+
+    `jobs` is consumed lazily and `on_result` runs on the event loop thread.
+    """
+    queue = asyncio.Queue[JobT | None](maxsize=concurrency * 2)
+    host_limits = defaultdict[str, asyncio.Semaphore](
+        lambda: asyncio.Semaphore(per_host_concurrency)
+    )
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+
+    async with httpx.AsyncClient(limits=limits, headers=headers) as client:
+
+        async def produce() -> None:
+            for job in jobs:
+                await queue.put(job)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def worker() -> None:
+            while (job := await queue.get()) is not None:
+                async with host_limits[urlparse(job.url).netloc]:
+                    res = await download(client, job)
+                on_result(job, res)
 
-    return ImageResult(extension=extension, content=res.content)
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            for _ in range(concurrency):
+                tg.create_task(worker())
@@ -0,0 +1,152 @@
+import bisect
+import json
+import threading
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from structlog.stdlib import BoundLogger
+
+# histogram bucket upper bounds in seconds, same spirit as prometheus' defaults
+_BUCKETS_SEC = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass(slots=True)
+class _Histogram:
+    count: int = 0
+    total_sec: float = 0.0
+    max_sec: float = 0.0
+    # one more than the buckets for everything slower than the last one
+    bucket_counts: list[int] = field(
+        default_factory=lambda: [0] * (len(_BUCKETS_SEC) + 1)
+    )
+
+    def observe(self, duration_sec: float) -> None:
+        self.count += 1
+        self.total_sec += duration_sec
+        self.max_sec = max(self.max_sec, duration_sec)
+        self.bucket_counts[bisect.bisect_left(_BUCKETS_SEC, duration_sec)] += 1
+
+    def quantile_sec(self, q: float) -> float:
+        """
+        Upper bound of the bucket the quantile falls in.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(_BUCKETS_SEC, self.bucket_counts, strict=False):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.max_sec
+
+
+@dataclass(slots=True)
+class Metrics:
+    """
+    Counters and latency histograms for the phases of a run, e.g. waiting on
+    http, parsing, writing to sqlite. Safe to use from any thread.
+    """
+
+    _phases: dict[str, _Histogram] = field(default_factory=dict[str, _Histogram])
+    _counters: dict[str, int] = field(default_factory=dict[str, int])
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def observe(self, phase: str, duration_sec: float) -> None:
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = _Histogram()
+            histogram.observe(duration_sec)
+
+    @contextmanager
+    def time(self, phase: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def incr(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "phases": {
+                    phase: {
+                        "count": h.count,
+                        "total_sec": round(h.total_sec, 6),
+                        "mean_ms": round(h.total_sec / h.count * 1000, 3),
+                        "p50_ms": h.quantile_sec(0.5) * 1000,
+                        "p95_ms": h.quantile_sec(0.95) * 1000,
+                        "max_ms": round(h.max_sec * 1000, 3),
+                    }
+                    for phase, h in sorted(self._phases.items())
+                },
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._phases and not self._counters
+
+    def log_summary(self, log: "BoundLogger") -> None:
+        summary = self.summary()
+        for phase, stats in summary["phases"].items():
+            log.info("phase timing", phase=phase, **stats)
+        if summary["counters"]:
+            log.info("counters", **summary["counters"])
+
+    def _prometheus(self) -> str:
+        lines = [
+            "# HELP tiktoker_phase_duration_seconds Time spent in each phase of a run.",
+            "# TYPE tiktoker_phase_duration_seconds histogram",
+        ]
+        with self._lock:
+            for phase, h in sorted(self._phases.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    (*_BUCKETS_SEC, "+Inf"), h.bucket_counts, strict=True
+                ):
+                    cumulative += bucket_count
+                    lines.append(
+                        f'tiktoker_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'tiktoker_phase_duration_seconds_sum{{phase="{phase}"}} {h.total_sec}'
+                )
+                lines.append(
+                    f'tiktoker_phase_duration_seconds_count{{phase="{phase}"}} {h.count}'
+                )
+            lines += [
+                "# HELP tiktoker_events_total Things counted during a run.",
+                "# TYPE tiktoker_events_total counter",
+            ]
+            lines += [
+                f'tiktoker_events_total{{event="{counter}"}} {value}'
+                for counter, value in sorted(self._counters.items())
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        """
+        Write a prometheus textfile if `path` ends in `.prom`, json otherwise.
+
+        The file is replaced atomically so a collector never reads half of it.
+        """
+        if path.suffix == ".prom":
+            text = self._prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2) + "\n"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(text)
+        tmp_path.replace(path)
+
+
+# shared by everything in the process, like the structlog logger
+metrics = Metrics()
@@ -0,0 +1,647 @@
+import hashlib
+import sqlite3
+from collections.abc import Callable, Iterator
+
+from structlog.stdlib import BoundLogger
+
+
+def _statements(script: str) -> Iterator[str]:
+    """
+    Split a script into statements so it can run inside a transaction,
+    `executescript` always commits before running.
+    """
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+    if statement.strip():
+        yield statement
+
+
+def _run(conn: sqlite3.Connection, script: str) -> None:
+    for statement in _statements(script):
+        conn.execute(statement)
+
+
+def _add_column_if_missing(
+    conn: sqlite3.Connection, table: str, column_def: str
+) -> None:
+    column_name = column_def.split()[0]
+    columns = {row[1] for row in conn.execute(f"pragma table_xinfo({table})")}
+    if column_name not in columns:
+        conn.execute(f"alter table {table} add column {column_def}")
+
+
+def _0001_initial(conn: sqlite3.Connection) -> None:
+    # databases from before migrations existed already have these tables
+    _run(
+        conn,
+        """
+create table if not exists tiktok_export (
+    id integer primary key,
+    completed_at text, -- TODO: only one of the rows should be able to have: completed_at is null
+    cursor integer not null,
+    created_at text default current_timestamp not null
+) strict;
+
+create table if not exists tiktok_posts (
+    id integer primary key,
+
+    export_id integer not null,
+
+    http_request_url text not null,
+    http_request_duration_sec real not null,
+    http_request_param_cursor integer not null,
+    http_response_headers_json text not null check (json_valid(http_response_headers_json)),
+
+    post_id text generated always AS (json_extract(post_json, '$.id')) virtual,
+    post_author text generated always AS (json_extract(post_json, '$.author.uniqueId')) virtual,
+    post_is_video integer generated always AS (json_extract(post_json, '$.imagePost') IS NULL) virtual,
+    post_created_at integer generated always AS (json_extract(post_json, '$.createTime')) virtual,
+    post_json text not null check (json_valid(post_json)),
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id)
+) strict;
+
+create unique index if not exists
+    unique_videos_per_export on tiktok_posts (export_id, post_id);
+""",
+    )
+    # null when the request reused a pooled connection
+    _add_column_if_missing(conn, "tiktok_posts", "http_request_connect_sec real")
+    _add_column_if_missing(conn, "tiktok_posts", "http_request_tls_sec real")
+
+
+def _0002_stored_post_columns(conn: sqlite3.Connection) -> None:
+    # sqlite can't change a generated column from virtual to stored so we
+    # have to rebuild the table.
+    _run(
+        conn,
+        """
+create table tiktok_posts_new (
+    id integer primary key,
+
+    export_id integer not null,
+
+    http_request_url text not null,
+    http_request_duration_sec real not null,
+    -- null when the request reused a pooled connection
+    http_request_connect_sec real,
+    http_request_tls_sec real,
+    http_request_param_cursor integer not null,
+    http_response_headers_json text not null check (json_valid(http_response_headers_json)),
+
+    post_id text generated always AS (json_extract(post_json, '$.id')) stored,
+    post_author text generated always AS (json_extract(post_json, '$.author.uniqueId')) stored,
+    post_is_video integer generated always AS (json_extract(post_json, '$.imagePost') IS NULL) stored,
+    post_created_at integer generated always AS (json_extract(post_json, '$.createTime')) stored,
+    post_json text not null check (json_valid(post_json)),
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id)
+) strict;
+
+insert into tiktok_posts_new (
+    id,
+    export_id,
+    http_request_url,
+    http_request_duration_sec,
+    http_request_connect_sec,
+    http_request_tls_sec,
+    http_request_param_cursor,
+    http_response_headers_json,
+    post_json,
+    created_at
+)
+select
+    id,
+    export_id,
+    http_request_url,
+    http_request_duration_sec,
+    http_request_connect_sec,
+    http_request_tls_sec,
+    http_request_param_cursor,
+    http_response_headers_json,
+    post_json,
+    created_at
+from tiktok_posts;
+
+drop table tiktok_posts;
+
+alter table tiktok_posts_new rename to tiktok_posts;
+
+create unique index
+    unique_videos_per_export on tiktok_posts (export_id, post_id);
+
+create index
+    tiktok_posts_export_cursor on tiktok_posts (export_id, http_request_param_cursor);
+
+create index
+    tiktok_posts_export_is_video on tiktok_posts (export_id, post_is_video);
+
+create index
+    tiktok_posts_author_created_at on tiktok_posts (post_author, post_created_at);
+""",
+    )
+
+
+def _0003_tiktok_requests(conn: sqlite3.Connection) -> None:
+    # Every post in a page shares the same http request metadata, so store it
+    # once per fetch instead of once per post.
+    #
+    # NOTE: run `VACUUM` afterwards to give the freed pages back to the OS.
+    _run(
+        conn,
+        """
+create table tiktok_requests (
+    id integer primary key,
+
+    export_id integer not null,
+
+    http_request_url text not null,
+    http_request_duration_sec real not null,
+    -- null when the request reused a pooled connection
+    http_request_connect_sec real,
+    http_request_tls_sec real,
+    http_request_param_cursor integer not null,
+    http_response_headers_json text not null check (json_valid(http_response_headers_json)),
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id)
+) strict;
+
+-- posts from the same fetch share all of these, the duration and response
+-- headers (which include a date) make each fetch unique.
+insert into tiktok_requests (
+    export_id,
+    http_request_url,
+    http_request_duration_sec,
+    http_request_connect_sec,
+    http_request_tls_sec,
+    http_request_param_cursor,
+    http_response_headers_json,
+    created_at
+)
+select
+    export_id,
+    http_request_url,
+    http_request_duration_sec,
+    max(http_request_connect_sec),
+    max(http_request_tls_sec),
+    http_request_param_cursor,
+    http_response_headers_json,
+    min(created_at)
+from tiktok_posts
+group by
+    export_id,
+    http_request_url,
+    http_request_duration_sec,
+    http_request_param_cursor,
+    http_response_headers_json
+order by min(id);
+
+create index
+    tiktok_requests_export_cursor on tiktok_requests (export_id, http_request_param_cursor);
+
+create table tiktok_posts_new (
+    id integer primary key,
+
+    export_id integer not null,
+    request_id integer not null,
+
+    post_id text generated always AS (json_extract(post_json, '$.id')) stored,
+    post_author text generated always AS (json_extract(post_json, '$.author.uniqueId')) stored,
+    post_is_video integer generated always AS (json_extract(post_json, '$.imagePost') IS NULL) stored,
+    post_created_at integer generated always AS (json_extract(post_json, '$.createTime')) stored,
+    post_json text not null check (json_valid(post_json)),
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id),
+    foreign key(request_id) references tiktok_requests(id)
+) strict;
+
+insert into tiktok_posts_new (id, export_id, request_id, post_json, created_at)
+select
+    tiktok_posts.id,
+    tiktok_posts.export_id,
+    tiktok_requests.id,
+    tiktok_posts.post_json,
+    tiktok_posts.created_at
+from tiktok_posts
+join tiktok_requests on
+    tiktok_requests.export_id = tiktok_posts.export_id
+    and tiktok_requests.http_request_url = tiktok_posts.http_request_url
+    and tiktok_requests.http_request_duration_sec = tiktok_posts.http_request_duration_sec
+    and tiktok_requests.http_request_param_cursor = tiktok_posts.http_request_param_cursor
+    and tiktok_requests.http_response_headers_json = tiktok_posts.http_response_headers_json;
+
+drop table tiktok_posts;
+
+alter table tiktok_posts_new rename to tiktok_posts;
+
+create unique index
+    unique_videos_per_export on tiktok_posts (export_id, post_id);
+
+create index
+    tiktok_posts_request_id on tiktok_posts (request_id);
+
+create index
+    tiktok_posts_export_is_video on tiktok_posts (export_id, post_is_video);
+
+create index
+    tiktok_posts_author_created_at on tiktok_posts (post_author, post_created_at);
+""",
+    )
+
+
+def _0004_compressible_post_json(conn: sqlite3.Connection) -> None:
+    # `post_json` can now be either json text or a compressed blob, see
+    # `PostJsonCompressor`. The `decompress_json` function is registered on
+    # the connection in `DB.create`.
+    _run(
+        conn,
+        """
+create table tiktok_compression_dicts (
+    id integer primary key,
+    codec text not null check (codec in ('none', 'zlib', 'zstd')),
+    dict blob,
+    created_at text default current_timestamp not null
+) strict;
+
+create table tiktok_posts_new (
+    id integer primary key,
+
+    export_id integer not null,
+    request_id integer not null,
+
+    post_id text generated always AS (json_extract(decompress_json(post_json), '$.id')) stored,
+    post_author text generated always AS (json_extract(decompress_json(post_json), '$.author.uniqueId')) stored,
+    post_is_video integer generated always AS (json_extract(decompress_json(post_json), '$.imagePost') IS NULL) stored,
+    post_created_at integer generated always AS (json_extract(decompress_json(post_json), '$.createTime')) stored,
+    post_json any not null check (json_valid(decompress_json(post_json))),
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id),
+    foreign key(request_id) references tiktok_requests(id)
+) strict;
+
+insert into tiktok_posts_new (id, export_id, request_id, post_json, created_at)
+select id, export_id, request_id, post_json, created_at
+from tiktok_posts;
+
+drop table tiktok_posts;
+
+alter table tiktok_posts_new rename to tiktok_posts;
+
+create unique index
+    unique_videos_per_export on tiktok_posts (export_id, post_id);
+
+create index
+    tiktok_posts_request_id on tiktok_posts (request_id);
+
+create index
+    tiktok_posts_export_is_video on tiktok_posts (export_id, post_is_video);
+
+create index
+    tiktok_posts_author_created_at on tiktok_posts (post_author, post_created_at);
+""",
+    )
+
+
+def _sha256(post_json: str) -> bytes:
+    # same as `db.post_body_hash`
+    return hashlib.sha256(post_json.encode()).digest()
+
+
+def _0005_post_bodies(conn: sqlite3.Connection) -> None:
+    # Store each distinct post payload once, keyed by the sha256 of its json,
+    # and keep a small membership row per export. An unchanged post no longer
+    # costs a full copy of its json in every export.
+    #
+    # This also drops the `decompress_json` generated columns and check from
+    # 0004 so the schema no longer depends on app defined functions.
+    conn.create_function("sha256", 1, _sha256, deterministic=True)
+    _run(
+        conn,
+        """
+create table tiktok_post_bodies (
+    id integer primary key,
+
+    hash blob not null unique,
+
+    -- Filled from the json on insert. These aren't generated columns since
+    -- `post_json` can be compressed and generated columns that depend on
+    -- an app defined function make the table unreadable in the sqlite3 cli.
+    post_id text not null,
+    post_author text,
+    post_is_video integer not null,
+    post_created_at integer,
+    -- json text or a compressed blob, see `PostJsonCompressor`
+    post_json any not null check (typeof(post_json) in ('text', 'blob')),
+
+    created_at text default current_timestamp not null
+) strict;
+
+insert or ignore into tiktok_post_bodies (
+    hash,
+    post_id,
+    post_author,
+    post_is_video,
+    post_created_at,
+    post_json,
+    created_at
+)
+select
+    sha256(decompress_json(post_json)),
+    post_id,
+    post_author,
+    post_is_video,
+    post_created_at,
+    post_json,
+    created_at
+from tiktok_posts
+order by id;
+
+create index
+    tiktok_post_bodies_post_id on tiktok_post_bodies (post_id);
+
+create index
+    tiktok_post_bodies_author_created_at on tiktok_post_bodies (post_author, post_created_at);
+
+create table tiktok_posts_new (
+    id integer primary key,
+
+    export_id integer not null,
+    request_id integer not null,
+
+    -- copied from the body so the per export lookups can be indexed
+    post_id text not null,
+    post_is_video integer not null,
+    body_hash blob not null,
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id),
+    foreign key(request_id) references tiktok_requests(id),
+    foreign key(body_hash) references tiktok_post_bodies(hash)
+) strict;
+
+insert into tiktok_posts_new (
+    id,
+    export_id,
+    request_id,
+    post_id,
+    post_is_video,
+    body_hash,
+    created_at
+)
+select
+    id,
+    export_id,
+    request_id,
+    post_id,
+    post_is_video,
+    sha256(decompress_json(post_json)),
+    created_at
+from tiktok_posts;
+
+drop table tiktok_posts;
+
+alter table tiktok_posts_new rename to tiktok_posts;
+
+create unique index
+    unique_videos_per_export on tiktok_posts (export_id, post_id);
+
+create index
+    tiktok_posts_request_id on tiktok_posts (request_id);
+
+create index
+    tiktok_posts_export_is_video on tiktok_posts (export_id, post_is_video);
+
+create index
+    tiktok_posts_body_hash on tiktok_posts (body_hash);
+""",
+    )
+
+
+def _0006_tiktok_media(conn: sqlite3.Connection) -> None:
+    # what the slideshow exporter has already saved to disk so re-runs can
+    # skip it
+    _run(
+        conn,
+        """
+create table tiktok_media (
+    id integer primary key,
+
+    post_id text not null,
+    slide_index integer not null,
+
+    url text not null,
+    path text,
+    size_bytes integer,
+    sha256 text,
+    status text not null check (status in ('complete', 'failed', 'expired')),
+    error text,
+
+    created_at text default current_timestamp not null,
+    updated_at text default current_timestamp not null
+) strict;
+
+create unique index
+    unique_media_per_slide on tiktok_media (post_id, slide_index);
+""",
+    )
+
+
+def _0007_tiktok_export_shards(conn: sqlite3.Connection) -> None:
+    # an export can be crawled as several time ranges in parallel, each with
+    # its own checkpoint
+    _run(
+        conn,
+        """
+create table tiktok_export_shards (
+    id integer primary key,
+
+    export_id integer not null,
+
+    created_before integer not null,
+    created_after integer not null,
+    cursor integer not null,
+    completed_at text,
+
+    created_at text default current_timestamp not null,
+
+    foreign key(export_id) references tiktok_export(id)
+) strict;
+
+create index
+    tiktok_export_shards_export_id on tiktok_export_shards (export_id);
+""",
+    )
+
+
+def _0008_tiktok_export_account(conn: sqlite3.Connection) -> None:
+    # several accounts can be exported into one db, each with its own export
+    # in progress. null for exports from before this.
+    _run(
+        conn,
+        """
+alter table tiktok_export add column account text;
+
+create unique index
+    tiktok_export_in_progress_per_account on tiktok_export (account)
+    where completed_at is null;
+""",
+    )
+
+
+def _0009_tiktok_post_search(conn: sqlite3.Connection) -> None:
+    # Full text index over the newest version of each post. The trigger keeps
+    # it up to date as bodies are inserted, it needs `decompress_json` so only
+    # tiktoker can insert posts, reading works anywhere.
+    _run(
+        conn,
+        """
+create virtual table tiktok_post_search using fts5(
+    description,
+    author,
+    hashtags,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- matches in the author and hashtags count for more than in the description
+insert into tiktok_post_search(tiktok_post_search, rank)
+values ('rank', 'bm25(1.0, 2.0, 2.0)');
+
+create trigger tiktok_post_search_insert after insert on tiktok_post_bodies
+begin
+    delete from tiktok_post_search
+    where rowid in (
+        select id from tiktok_post_bodies
+        where post_id = new.post_id and id != new.id
+    );
+    insert into tiktok_post_search(rowid, description, author, hashtags)
+    select
+        new.id,
+        json_extract(post_json, '$.desc'),
+        coalesce(json_extract(post_json, '$.author.uniqueId'), '')
+            || ' ' || coalesce(json_extract(post_json, '$.author.nickname'), ''),
+        (
+            select group_concat(json_extract(value, '$.title'), ' ')
+            from json_each(post_json, '$.challenges')
+        )
+    from (select decompress_json(new.post_json) as post_json);
+end;
+
+insert into tiktok_post_search(rowid, description, author, hashtags)
+select
+    id,
+    json_extract(post_json, '$.desc'),
+    coalesce(json_extract(post_json, '$.author.uniqueId'), '')
+        || ' ' || coalesce(json_extract(post_json, '$.author.nickname'), ''),
+    (
+        select group_concat(json_extract(value, '$.title'), ' ')
+        from json_each(post_json, '$.challenges')
+    )
+from (
+    select id, decompress_json(post_json) as post_json
+    from tiktok_post_bodies
+    where id in (select max(id) from tiktok_post_bodies group by post_id)
+);
+""",
+    )
+
+
+def _0010_tiktok_jobs(conn: sqlite3.Connection) -> None:
+    # slides waiting to be downloaded by `tiktoker worker`. A worker leases
+    # the jobs it claims and keeps extending the lease while it's alive, a
+    # job whose lease ran out is claimed again by the next worker.
+    _run(
+        conn,
+        """
+create table tiktok_jobs (
+    id integer primary key,
+
+    post_id text not null,
+    slide_index integer not null,
+    url text not null,
+    filename_stem text not null,
+    -- unix timestamp the url stops working at, soonest are claimed first
+    expires_at integer,
+
+    status text not null default 'pending'
+        check (status in ('pending', 'leased', 'complete', 'failed', 'expired')),
+    attempts integer not null default 0,
+    lease_owner text,
+    -- unix timestamp, fractional
+    lease_expires_at real,
+    error text,
+
+    created_at text default current_timestamp not null,
+    updated_at text default current_timestamp not null
+) strict;
+
+create unique index
+    unique_job_per_slide on tiktok_jobs (post_id, slide_index);
+
+-- in the order jobs are claimed, so claiming never sorts the whole queue
+create index
+    tiktok_jobs_claim_order on tiktok_jobs (
+        status, ifnull(expires_at, 9223372036854775807), id
+    );
+
+create index
+    tiktok_jobs_lease_owner on tiktok_jobs (lease_owner) where lease_owner is not null;
+""",
+    )
+
+
+# Append only! Each migration runs once, in order, and `user_version` records
+# how many have been applied.
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    _0001_initial,
+    _0002_stored_post_columns,
+    _0003_tiktok_requests,
+    _0004_compressible_post_json,
+    _0005_post_bodies,
+    _0006_tiktok_media,
+    _0007_tiktok_export_shards,
+    _0008_tiktok_export_account,
+    _0009_tiktok_post_search,
+    _0010_tiktok_jobs,
+]
+
+
+def _user_version(conn: sqlite3.Connection) -> int:
+    (version,) = conn.execute("pragma user_version").fetchone()
+    return version
+
+
+def migrate(conn: sqlite3.Connection, log: BoundLogger) -> None:
+    if _user_version(conn) >= len(MIGRATIONS):
+        return
+    while True:
+        # take the write lock before reading the version so concurrent
+        # processes don't run the same migration twice.
+        conn.execute("begin immediate")
+        try:
+            version = _user_version(conn)
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return
+            migration = MIGRATIONS[version]
+            log.info("migrating db", version=version + 1, migration=migration.__name__)
+            migration(conn)
+            conn.execute(f"pragma user_version = {version + 1}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
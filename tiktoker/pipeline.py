@@ -0,0 +1,96 @@
+import queue
+import threading
+from collections.abc import Generator, Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+class _Done:
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class _Failed:
+    exc: BaseException
+
+
+@contextmanager
+def prefetch(
+    source: Iterator[T], *, maxsize: int
+) -> Generator[Iterator[T], None, None]:
+    """
+    Pull items from `source` on a background thread so the caller can work on
+    item N while item N+1 is being produced.
+
+    At most `maxsize` items are buffered, after which the producer blocks
+    until the caller catches up. Exceptions raised by `source` are re-raised
+    in the caller. Leaving the block stops the producer, so items that were
+    fetched but never consumed are dropped.
+    """
+    with prefetch_many([source], maxsize=maxsize) as items:
+        yield (item for _, item in items)
+
+
+@contextmanager
+def prefetch_many(
+    sources: Sequence[Iterator[T]], *, maxsize: int
+) -> Generator[Iterator[tuple[int, T]], None, None]:
+    """
+    Like `prefetch` but with a thread per source, all feeding one buffer.
+
+    Items are yielded with the index of the source they came from, in
+    whatever order they're produced. The first exception raised by any
+    source is re-raised in the caller.
+    """
+    buffer = queue.Queue[tuple[int, T] | _Done | _Failed](maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item: tuple[int, T] | _Done | _Failed) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce(idx: int, source: Iterator[T]) -> None:
+        try:
+            for item in source:
+                if not put((idx, item)):
+                    return
+        except BaseException as e:  # noqa: BLE001
+            put(_Failed(e))
+        else:
+            put(_Done())
+
+    def consume() -> Iterator[tuple[int, T]]:
+        remaining = len(sources)
+        while remaining:
+            item = buffer.get()
+            if isinstance(item, _Done):
+                remaining -= 1
+                continue
+            if isinstance(item, _Failed):
+                raise item.exc
+            yield item
+
+    producers = [
+        threading.Thread(
+            target=produce, args=(idx, source), name=f"prefetch-{idx}", daemon=True
+        )
+        for idx, source in enumerate(sources)
+    ]
+    for producer in producers:
+        producer.start()
+    try:
+        yield consume()
+    except BaseException:
+        stopped.set()
+        raise
+    stopped.set()
+    for producer in producers:
+        producer.join()
@@ -0,0 +1,51 @@
+import cProfile
+import pstats
+import sys
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+
+from structlog.stdlib import BoundLogger
+
+# how many functions and allocation sites to show
+_TOP_N = 25
+
+
+def start_profiling() -> Callable[[Path, BoundLogger], None]:
+    """
+    Start cProfile and tracemalloc. Returns a function that stops both, saves
+    the cProfile stats to a path (for snakeviz and friends) and reports the
+    hottest functions and biggest allocation sites.
+
+    cProfile only sees the thread that started it, so time spent on the
+    prefetch threads shows up as waiting on the queue.
+    """
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def stop(path: Path, log: BoundLogger) -> None:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            pstats.SortKey.CUMULATIVE
+        ).print_stats(_TOP_N)
+        for stat in snapshot.statistics("lineno")[:_TOP_N]:
+            log.info(
+                "allocation site",
+                location=str(stat.traceback),
+                size_bytes=stat.size,
+                count=stat.count,
+            )
+        log.info(
+            "profile saved",
+            path=str(path),
+            traced_memory_bytes=current_bytes,
+            traced_memory_peak_bytes=peak_bytes,
+        )
+
+    return stop
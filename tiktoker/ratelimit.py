@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+
+import httpx
+from structlog.stdlib import BoundLogger, get_logger
+
+logger = get_logger()
+
+# how often to log the current rate while it's going up
+_LOG_INTERVAL_SEC = 30.0
+
+# responses that arrive together are usually reacting to the same overload,
+# so only back off once per window
+_DECREASE_WINDOW_SEC = 1.0
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """
+    `Retry-After` is either a number of seconds or an HTTP date.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(tz=UTC)).total_seconds())
+
+
+def _is_throttled(status_code: int | None) -> bool:
+    # `None` means the request didn't get a response at all, which is what an
+    # overloaded server looks like too.
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+@dataclass(slots=True)
+class AdaptiveRateLimiter:
+    """
+    Paces requests to a single host.
+
+    Requests are spaced out to `rate` per second. The rate doubles-ish while
+    responses come back fast and successful (slow start), then grows
+    additively after the first back off, and is halved on 429s, 5xxs and
+    connection errors (AIMD). A `Retry-After` header pauses every request to
+    the host until it has passed.
+
+    Safe to share between threads and event loops.
+    """
+
+    log: BoundLogger
+    rate: float = 4.0
+    min_rate: float = 0.2
+    max_rate: float = 200.0
+    # slower responses than this don't count as healthy
+    latency_target_sec: float = 5.0
+    _slow_start: bool = True
+    _next_at: float = 0.0
+    _paused_until: float = 0.0
+    _last_decrease_at: float = 0.0
+    _last_logged_at: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def _reserve(self) -> float:
+        """
+        Claim the next request slot and return how long to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_at, self._paused_until)
+            self._next_at = start + 1 / self.rate
+            return start - now
+
+    def wait(self) -> None:
+        time.sleep(self._reserve())
+
+    async def wait_async(self) -> None:
+        await asyncio.sleep(self._reserve())
+
+    def observe(
+        self,
+        *,
+        status_code: int | None,
+        latency_sec: float,
+        retry_after: str | None = None,
+    ) -> None:
+        with self._lock:
+            now = time.monotonic()
+            retry_after_sec = _parse_retry_after(retry_after)
+            if retry_after_sec is not None:
+                self._paused_until = max(self._paused_until, now + retry_after_sec)
+            if _is_throttled(status_code):
+                if now - self._last_decrease_at < _DECREASE_WINDOW_SEC:
+                    return
+                self._last_decrease_at = now
+                self._slow_start = False
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.log.warning(
+                    "throttled, lowering request rate",
+                    rate=round(self.rate, 2),
+                    status_code=status_code,
+                    retry_after_sec=retry_after_sec,
+                )
+                return
+            if latency_sec > self.latency_target_sec:
+                return
+            increase = 1.0 if self._slow_start else 1 / self.rate
+            self.rate = min(self.max_rate, self.rate + increase)
+            if now - self._last_logged_at >= _LOG_INTERVAL_SEC:
+                self._last_logged_at = now
+                self.log.info("request rate", rate=round(self.rate, 2))
+
+    def observe_response(self, res: httpx.Response, *, latency_sec: float) -> None:
+        self.observe(
+            status_code=res.status_code,
+            latency_sec=latency_sec,
+            retry_after=res.headers.get("retry-after"),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimiters:
+    """
+    One `AdaptiveRateLimiter` per host, shared by every client that's given
+    this object.
+    """
+
+    _limiters: dict[str, AdaptiveRateLimiter] = field(
+        default_factory=dict[str, AdaptiveRateLimiter]
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def for_url(self, url: str | httpx.URL) -> AdaptiveRateLimiter:
+        host = httpx.URL(url).host
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = AdaptiveRateLimiter(logger.bind(host=host))
+                self._limiters[host] = limiter
+            return limiter
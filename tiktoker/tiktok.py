@@ -1,30 +1,53 @@
+import json
+import re
 import time
-from collections.abc import Iterator
-from dataclasses import dataclass
-from typing import Any
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from types import TracebackType
+from typing import Any, Self
 
 import httpx
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, ConfigDict, ValidationError
 from structlog.stdlib import BoundLogger, get_logger
 from tenacity import retry, retry_if_exception_type, wait_exponential, wait_random
 
+from tiktoker.metrics import metrics
+from tiktoker.ratelimit import AdaptiveRateLimiter, RateLimiters
+
 logger = get_logger()
 
 
+class RawPost(BaseModel):
+    """
+    A post as the exact json text TikTok sent, plus the fields we need before
+    it's saved. Everything else is read from the text by sqlite.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    id: str
+    text: str
+
+
 @dataclass(frozen=True, slots=True)
 class FetchResult:
     cursor: int
     duration_sec: float
-    posts: list[dict[str, Any]]
+    connect_sec: float | None
+    tls_sec: float | None
+    posts: list[RawPost]
     response_headers: httpx.Headers
     request_headers: httpx.Headers
     request_url: str
+    is_last: bool
 
 
 @dataclass(frozen=True, slots=True)
 class DownloadResult:
     duration_sec: float
-    posts: list[dict[str, Any]]
+    connect_sec: float | None
+    tls_sec: float | None
+    posts: list[RawPost]
     has_more: bool
     cursor: int
     response_headers: httpx.Headers
@@ -32,14 +55,168 @@ class DownloadResult:
     request_url: str
 
 
+class _PostFields(BaseModel):
+    id: str
+
+
 class ListPage(BaseModel):
     hasMore: bool  # noqa: N815
     cursor: int
-    itemList: list[dict[str, Any]]  # noqa: N815
+    itemList: list[RawPost]  # noqa: N815
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _parse_list_page(content: bytes) -> ListPage:
+    """
+    Parse a favorites page without round tripping the posts through python
+    objects and back to json.
+
+    The top level object and `itemList` are walked by hand, every value in
+    them is decoded with the stdlib's C decoder, which also gives its span.
+    Each item is kept as its original text and only its id is read from the
+    decoded copy, so at most one post is held as python objects at a time.
+    """
+    text = content.decode()
+
+    def skip_whitespace(idx: int) -> int:
+        match = _WHITESPACE.match(text, idx)
+        assert match is not None, "matches the empty string"
+        return match.end()
+
+    def expect(idx: int, char: str) -> int:
+        idx = skip_whitespace(idx)
+        if text[idx : idx + 1] != char:
+            raise json.JSONDecodeError(f"Expecting {char!r}", text, idx)
+        return skip_whitespace(idx + 1)
+
+    def elements(idx: int, close: str, parse_element: Callable[[int], int]) -> int:
+        """
+        Parse comma separated elements up to `close` and return the index after
+        it. `parse_element` returns the index after its element.
+        """
+        if text[idx : idx + 1] != close:
+            idx = skip_whitespace(parse_element(idx))
+            while text[idx : idx + 1] == ",":
+                idx = skip_whitespace(parse_element(skip_whitespace(idx + 1)))
+        return expect(idx, close)
+
+    posts: list[RawPost] = []
+
+    def parse_item(idx: int) -> int:
+        item, end = _decoder.raw_decode(text, idx)
+        posts.append(
+            RawPost(id=_PostFields.model_validate(item).id, text=text[idx:end])
+        )
+        return end
+
+    fields: dict[str, Any] = {}
+
+    def parse_field(idx: int) -> int:
+        if text[idx : idx + 1] != '"':
+            raise json.JSONDecodeError(
+                "Expecting property name enclosed in double quotes", text, idx
+            )
+        key, idx = _decoder.raw_decode(text, idx)
+        idx = expect(idx, ":")
+        if key == "itemList":
+            idx = elements(expect(idx, "["), "]", parse_item)
+            fields[key] = posts
+            return idx
+        fields[key], idx = _decoder.raw_decode(text, idx)
+        return idx
+
+    idx = elements(expect(0, "{"), "}", parse_field)
+    if idx != len(text):
+        raise json.JSONDecodeError("Extra data", text, idx)
+    return ListPage.model_validate(fields)
+
+
+BASE_URL = "https://www.tiktok.com"
+
+_FAVORITES_PATH = "/api/user/collect/item_list/"
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15"
+
+_HEADERS = {
+    "Pragma": "no-cache",
+    "Accept": "*/*",
+    "Sec-Fetch-Site": "same-origin",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Sec-Fetch-Mode": "cors",
+    "Cache-Control": "no-cache",
+    "User-Agent": USER_AGENT,
+    "Referer": "https://www.tiktok.com/@thegamesteam",
+    "Sec-Fetch-Dest": "empty",
+}
+
+_PARAMS = {
+    # NOTE: this is most of the query params
+    # I removed: device_id, secUid, verifyFp
+    # since they looked secret/sensitive, but it still works.
+    # We might be able to remove more values, not sure!
+    "WebIdLastTime": "0",
+    "aid": "1988",
+    "app_language": "en",
+    "app_name": "tiktok_web",
+    "browser_language": "en-US",
+    "browser_name": "Mozilla",
+    "browser_online": "true",
+    "browser_platform": "MacIntel",
+    "browser_version": "5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
+    "channel": "tiktok_web",
+    "cookie_enabled": "true",
+    "count": "30",
+    "coverFormat": "0",
+    "device_platform": "web_pc",
+    "focus_state": "false",
+    "from_page": "user",
+    "history_len": "4",
+    "is_fullscreen": "false",
+    "is_page_visible": "true",
+    "language": "en",
+    "os": "mac",
+    "priority_region": "US",
+    "region": "US",
+    "screen_height": "982",
+    "screen_width": "1512",
+    "tz_name": "America/New_York",
+    "webcast_language": "en",
+}
+
+
+@dataclass(slots=True)
+class _ConnectionTimings:
+    """
+    httpcore `trace` extension callback that records how long the request
+    spent opening a connection. Both values stay `None` when a pooled
+    connection was reused.
+    """
+
+    connect_sec: float | None = None
+    tls_sec: float | None = None
+    _started: dict[str, float] = field(default_factory=dict[str, float])
+
+    def __call__(self, event_name: str, info: dict[str, Any]) -> None:
+        step, _, status = event_name.removeprefix("connection.").rpartition(".")
+        if step not in {"connect_tcp", "start_tls"}:
+            return
+        if status == "started":
+            self._started[step] = time.monotonic()
+        elif status == "complete":
+            duration_sec = time.monotonic() - self._started.pop(step)
+            if step == "connect_tcp":
+                self.connect_sec = duration_sec
+            else:
+                self.tls_sec = duration_sec
 
 
 @retry(
-    retry=retry_if_exception_type((httpx.HTTPError, ValidationError)),
+    retry=retry_if_exception_type(
+        (httpx.HTTPError, ValidationError, json.JSONDecodeError)
+    ),
     wait=wait_exponential(multiplier=1, min=0.5, max=15) + wait_random(0, 2),
     after=lambda x: logger.warning(
         "download favorites batch request failed. Retrying...",
@@ -47,77 +224,30 @@ class ListPage(BaseModel):
         exec=x.outcome is not None and x.outcome.exception(),  # pyright: ignore [reportUnknownMemberType]
     ),
 )
-def _download_favorites_batch(*, cursor: int, session_id: str) -> DownloadResult:
-    headers = {
-        "Pragma": "no-cache",
-        "Accept": "*/*",
-        "Sec-Fetch-Site": "same-origin",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Sec-Fetch-Mode": "cors",
-        "Cache-Control": "no-cache",
-        "Host": "www.tiktok.com",
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
-        "Referer": "https://www.tiktok.com/@thegamesteam",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "empty",
-    }
+def _download_favorites_batch(
+    client: httpx.Client, limiter: AdaptiveRateLimiter, *, cursor: int
+) -> DownloadResult:
+    limiter.wait()
+    timings = _ConnectionTimings()
     start = time.monotonic()
-    params = {
-        # NOTE: this is most of the query params
-        # I removed: device_id, secUid, verifyFp
-        # since they looked secret/sensitive, but it still works.
-        # We might be able to remove more values, not sure!
-        "WebIdLastTime": "0",
-        "aid": "1988",
-        "app_language": "en",
-        "app_name": "tiktok_web",
-        "browser_language": "en-US",
-        "browser_name": "Mozilla",
-        "browser_online": "true",
-        "browser_platform": "MacIntel",
-        "browser_version": "5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
-        "channel": "tiktok_web",
-        "cookie_enabled": "true",
-        "count": "30",
-        "coverFormat": "0",
-        "cursor": cursor,
-        "device_platform": "web_pc",
-        "focus_state": "false",
-        "from_page": "user",
-        "history_len": "4",
-        "is_fullscreen": "false",
-        "is_page_visible": "true",
-        "language": "en",
-        "os": "mac",
-        "priority_region": "US",
-        "region": "US",
-        "screen_height": "982",
-        "screen_width": "1512",
-        "tz_name": "America/New_York",
-        "webcast_language": "en",
-    }
-
-    cookies = {
-        # NOTE: there are a lot more values in the web api's cookies, but I
-        # removed all of them except sessionid to avoid leaking anything
-        # sensitive.
-        #
-        # If we start hitting auth issues or getting blocked, it would make
-        # sense to include all of the cookies here.
-        "sessionid": session_id,
-    }
-    res = httpx.get(
-        "https://www.tiktok.com/api/user/collect/item_list/",
-        params=params,
-        cookies=cookies,
-        headers=headers,
-    )
+    try:
+        res = client.get(
+            _FAVORITES_PATH, params={"cursor": cursor}, extensions={"trace": timings}
+        )
+    except httpx.TransportError:
+        limiter.observe(status_code=None, latency_sec=time.monotonic() - start)
+        raise
     end = time.monotonic()
     duration_sec = end - start
+    metrics.observe("api_http_wait", duration_sec)
+    limiter.observe_response(res, latency_sec=duration_sec)
     res.raise_for_status()
-    page = ListPage.model_validate_json(res.content)
+    with metrics.time("validate_page"):
+        page = _parse_list_page(res.content)
     return DownloadResult(
         duration_sec=duration_sec,
+        connect_sec=timings.connect_sec,
+        tls_sec=timings.tls_sec,
         posts=page.itemList,
         has_more=page.hasMore,
         cursor=page.cursor,
@@ -130,29 +260,101 @@ def _download_favorites_batch(*, cursor: int, session_id: str) -> DownloadResult
 @dataclass(frozen=True, slots=True)
 class TikTok:
     log: BoundLogger
-    session_id: str
+    _client: httpx.Client
+    _limiter: AdaptiveRateLimiter
+
+    @classmethod
+    def create(
+        cls,
+        log: BoundLogger,
+        *,
+        session_id: str,
+        http2: bool = False,
+        rate_limiters: RateLimiters | None = None,
+        max_connections: int = 4,
+        base_url: str | None = None,
+    ) -> Self:
+        """
+        `http2` requires the optional `h2` package to be installed.
+
+        `max_connections` should be at least the number of threads iterating
+        `favorites` at once.
+
+        `base_url` defaults to tiktok.com, it can point at a stand-in server,
+        see `bench/`.
 
-    def favorites(self, *, created_before: int) -> Iterator[FetchResult]:
+        Pass `rate_limiters` to share request pacing with other clients
+        talking to the same hosts.
+        """
+        base_url = base_url or BASE_URL
+        client = httpx.Client(
+            base_url=base_url,
+            headers=_HEADERS,
+            params=_PARAMS,
+            cookies={
+                # NOTE: there are a lot more values in the web api's cookies, but I
+                # removed all of them except sessionid to avoid leaking anything
+                # sensitive.
+                #
+                # If we start hitting auth issues or getting blocked, it would make
+                # sense to include all of the cookies here.
+                "sessionid": session_id,
+            },
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections, keepalive_expiry=60),
+        )
+        limiter = (rate_limiters or RateLimiters()).for_url(base_url)
+        return cls(log, client, limiter)
+
+    def close(self) -> None:
+        self._client.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def favorites(
+        self, *, created_before: int, created_after: int | None = None
+    ) -> Iterator[FetchResult]:
+        """
+        Pages of favorites, newest first, starting at the `created_before`
+        cursor. With `created_after`, stops once the cursor passes it, the last
+        page can still include a few posts from before it.
+        """
         page = 1
         has_more = True
         while has_more:
             res = _download_favorites_batch(
-                cursor=created_before, session_id=self.session_id
+                self._client, self._limiter, cursor=created_before
             )
             self.log.info(
                 "fetched batch",
                 cursor=created_before,
                 page=page,
                 duration_sec=res.duration_sec,
+                connect_sec=res.connect_sec,
+                tls_sec=res.tls_sec,
+            )
+            has_more = res.has_more and (
+                created_after is None or res.cursor > created_after
             )
             yield FetchResult(
                 cursor=created_before,
                 duration_sec=res.duration_sec,
+                connect_sec=res.connect_sec,
+                tls_sec=res.tls_sec,
                 posts=res.posts,
                 response_headers=res.response_headers,
                 request_headers=res.request_headers,
                 request_url=res.request_url,
+                is_last=not has_more,
             )
             page += 1
-            has_more = res.has_more
             created_before = res.cursor